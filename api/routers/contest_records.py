@@ -1,12 +1,18 @@
 import asyncio
+import base64
 from typing import List, Optional
 
 from beanie.operators import In
 from fastapi import APIRouter, Request
-from pydantic import BaseModel, NonNegativeInt, conint, conlist
+from pydantic import BaseModel, NonNegativeInt, conint, conlist, field_validator
 
 from api.utils import check_contest_name
-from app.db.models import ContestRecordArchive, ContestRecordPredict
+from app.db.codec import decode_real_time_rank, pack_real_time_rank
+from app.db.models import (
+    ContestRecordArchive,
+    ContestRecordPredict,
+    ContestRecordProvisional,
+)
 from app.db.views import UserKey
 
 router = APIRouter(
@@ -161,30 +167,70 @@ async def predicted_rating(
     return await asyncio.gather(*tasks)
 
 
+@router.post("/provisional-rating")
+async def provisional_rating(
+    request: Request,
+    query: QueryOfPredictedRating,
+) -> List[Optional[ResultOfPredictedRating]]:
+    """
+    Query multiple provisional records of an ongoing contest, they're recomputed every few minutes.
+    :param request:
+    :param query:
+    :return:
+    """
+    await check_contest_name(query.contest_name)
+    tasks = (
+        ContestRecordProvisional.find_one(
+            ContestRecordProvisional.contest_name == query.contest_name,
+            ContestRecordProvisional.data_region == user.data_region,
+            ContestRecordProvisional.username == user.username,
+            projection_model=ResultOfPredictedRating,
+        )
+        for user in query.users
+    )
+    return await asyncio.gather(*tasks)
+
+
 class QueryOfRealTimeRank(BaseModel):
     contest_name: str
     user: UserKey
+    # return `packed_real_time_rank` (base64 of `app.db.codec` bytes) instead of a plain list
+    packed: Optional[bool] = False
 
 
 class ResultOfRealTimeRank(BaseModel):
-    real_time_rank: Optional[list]
+    real_time_rank: Optional[list] = None
+    packed_real_time_rank: Optional[str] = None
+
+    @field_validator("real_time_rank", mode="before")
+    @classmethod
+    def decode_real_time_rank(cls, value):
+        return decode_real_time_rank(value)
 
 
 @router.post("/real-time-rank")
 async def real_time_rank(
     request: Request,
     query: QueryOfRealTimeRank,
-) -> ResultOfRealTimeRank:
+) -> Optional[ResultOfRealTimeRank]:
     """
     Query user's realtime rank list of a given contest.
+    Set `packed = True` to get a delta + zigzag varint encoded, base64 string instead, which is several times smaller.
     :param request:
     :param query:
     :return:
     """
     await check_contest_name(query.contest_name)
-    return await ContestRecordArchive.find_one(
+    result = await ContestRecordArchive.find_one(
         ContestRecordArchive.contest_name == query.contest_name,
         ContestRecordArchive.data_region == query.user.data_region,
         ContestRecordArchive.username == query.user.username,
         projection_model=ResultOfRealTimeRank,
     )
+    if query.packed and result and result.real_time_rank is not None:
+        return ResultOfRealTimeRank(
+            packed_real_time_rank=base64.b64encode(
+                pack_real_time_rank(result.real_time_rank, varint=True)
+            ).decode()
+        )
+    return result
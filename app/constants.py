@@ -3,6 +3,8 @@ from typing import Final, NamedTuple
 
 DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT: Final[int] = 0
 DEFAULT_NEW_USER_RATING: Final[float] = 1500.0
+# Ensure that the prediction error for rating deltas for EACH participant is within the specified precision limit
+RATING_DELTA_PRECISION: Final[float] = 0.05
 
 
 class CronTimePointWkdHrMin(NamedTuple):
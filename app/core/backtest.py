@@ -0,0 +1,219 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.core.predictor import (
+    PREDICTION_ENGINE,
+    PREDICTION_ENGINES,
+    select_prediction_engine,
+)
+from app.db.models import Contest, ContestRecordPredict, User
+from app.db.mongodb import get_async_mongodb_collection
+from app.handler.user import save_users_contest_history
+
+
+async def load_real_new_ratings(
+    contest_title: str,
+    keys: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], float]:
+    """
+    Real rating after a contest comes from `User.contest_history`, which is filled by `save_users_contest_history`.
+    :param contest_title:
+    :param keys: (username, data_region) list
+    :return: only users who have this contest in their history
+    """
+    col = get_async_mongodb_collection(User.__name__)
+    real_new_rating_map = dict()
+    for data_region in ("CN", "US"):
+        usernames = [username for username, region in keys if region == data_region]
+        if not usernames:
+            continue
+        async for doc in col.find(
+            {
+                "data_region": data_region,
+                "username": {"$in": usernames},
+                "contest_history.contest_title": contest_title,
+            },
+            {
+                "_id": 0,
+                "username": 1,
+                "contest_history": {"$elemMatch": {"contest_title": contest_title}},
+            },
+        ):
+            real_new_rating_map[(doc["username"], data_region)] = doc[
+                "contest_history"
+            ][0]["rating"]
+    return real_new_rating_map
+
+
+async def load_backtest_inputs(
+    contest_name: str,
+    contest_title: str,
+    fetch_history: bool = False,
+) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Load prediction inputs from ContestRecordPredict and real new_rating from `User.contest_history`.
+    Participants without this contest in their history get `nan`.
+    :param contest_name:
+    :param contest_title:
+    :param fetch_history: request contest history of participants who don't have this contest yet
+    :return: ranks, ratings, ks, real_new_ratings; None if either side is missing
+    """
+    predict_col = get_async_mongodb_collection(ContestRecordPredict.__name__)
+    predict_docs = await predict_col.find(
+        {"contest_name": contest_name, "score": {"$ne": 0}},
+        {
+            "_id": 0,
+            "username": 1,
+            "data_region": 1,
+            "rank": 1,
+            "old_rating": 1,
+            "attendedContestsCount": 1,
+        },
+        sort=[("rank", 1)],
+    ).to_list(length=None)
+    keys = [(doc["username"], doc["data_region"]) for doc in predict_docs]
+    real_new_rating_map = await load_real_new_ratings(contest_title, keys)
+    if fetch_history and (
+        missing_keys := [key for key in keys if key not in real_new_rating_map]
+    ):
+        logger.info(f"fetch contest history of {len(missing_keys)} users")
+        await asyncio.gather(
+            *(
+                save_users_contest_history(
+                    data_region,
+                    [
+                        username
+                        for username, region in missing_keys
+                        if region == data_region
+                    ],
+                )
+                for data_region in ("CN", "US")
+            )
+        )
+        real_new_rating_map = await load_real_new_ratings(contest_title, keys)
+    if not predict_docs or not real_new_rating_map:
+        return None
+    ranks = np.array([doc["rank"] for doc in predict_docs], dtype=np.float64)
+    ratings = np.array([doc["old_rating"] for doc in predict_docs], dtype=np.float64)
+    ks = np.array([doc["attendedContestsCount"] for doc in predict_docs])
+    real_new_ratings = np.array(
+        [real_new_rating_map.get(key, np.nan) for key in keys],
+        dtype=np.float64,
+    )
+    return ranks, ratings, ks, real_new_ratings
+
+
+def backtest_contest(
+    contest_name: str,
+    engine: PREDICTION_ENGINE,
+    ranks: np.ndarray,
+    ratings: np.ndarray,
+    ks: np.ndarray,
+    real_new_ratings: np.ndarray,
+) -> Dict:
+    """
+    Re-run a prediction engine on a single contest, runs in a worker process.
+    :param contest_name:
+    :param engine:
+    :param ranks:
+    :param ratings:
+    :param ks:
+    :param real_new_ratings:
+    :return:
+    """
+    engine = select_prediction_engine(engine, len(ranks))
+    t1 = time.time()
+    new_ratings = ratings + PREDICTION_ENGINES[engine](ranks, ratings, ks)
+    t2 = time.time()
+    matched = ~np.isnan(real_new_ratings)
+    errors = new_ratings[matched] - real_new_ratings[matched]
+    return {
+        "contest_name": contest_name,
+        "engine": engine,
+        "user_num": len(ranks),
+        "matched_num": len(errors),
+        "seconds": round(t2 - t1, 4),
+        "mae": float(np.mean(np.abs(errors))) if len(errors) else None,
+        "rmse": float(np.sqrt(np.mean(errors**2))) if len(errors) else None,
+        "max_error": float(np.max(np.abs(errors))) if len(errors) else None,
+    }
+
+
+async def run_backtest(
+    engine: PREDICTION_ENGINE = "auto",
+    max_workers: Optional[int] = None,
+    output: str = "backtest.json",
+    fetch_history: bool = False,
+) -> List[Dict]:
+    """
+    Backtest an engine against every contest which has both predicted records and real ratings in users' history,
+    contests are spread across a process pool while the next contest is loading.
+    Raise if no contest can be compared, an empty report is not a successful backtest.
+    :param engine:
+    :param max_workers:
+    :param output:
+    :param fetch_history: request missing contest history of participants, see `load_backtest_inputs`
+    :return:
+    """
+    contests = (
+        await Contest.find(
+            Contest.predict_time > datetime(1970, 1, 1),
+        )
+        .sort(-Contest.startTime)
+        .to_list()
+    )
+    logger.info(f"{len(contests)=} predicted contests to backtest with {engine=}")
+    loop = asyncio.get_running_loop()
+    futures = list()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for contest in contests:
+            if (
+                inputs := await load_backtest_inputs(
+                    contest.titleSlug, contest.title, fetch_history
+                )
+            ) is None:
+                logger.info(
+                    f"skip {contest.titleSlug=}, no predicted data or real ratings"
+                )
+                continue
+            futures.append(
+                loop.run_in_executor(
+                    pool, partial(backtest_contest, contest.titleSlug, engine, *inputs)
+                )
+            )
+        results = await asyncio.gather(*futures)
+    for result in results:
+        logger.info(f"{result=}")
+    matched_results = [r for r in results if r["matched_num"]]
+    summary = {
+        "engine": engine,
+        "contest_num": len(matched_results),
+        "mean_mae": (
+            float(np.mean([r["mae"] for r in matched_results]))
+            if matched_results
+            else None
+        ),
+        "mean_rmse": (
+            float(np.mean([r["rmse"] for r in matched_results]))
+            if matched_results
+            else None
+        ),
+        "total_seconds": round(sum(r["seconds"] for r in results), 4),
+    }
+    logger.success(f"backtest finished {summary=}")
+    with open(output, "w") as f:
+        json.dump({"summary": summary, "contests": results}, f, indent=2)
+        f.write("\n")
+    if not matched_results:
+        raise RuntimeError(
+            "no contest has real ratings in User.contest_history, run backtest with --fetch-history"
+        )
+    return results
@@ -1,44 +1,45 @@
-from functools import lru_cache
 from typing import Final
 
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
+# When k is bigger than this, delta coefficient approximately equals to 2/9.
+DELTA_COEFFICIENT_MAX_K: Final[int] = 100
 
-@lru_cache
-def pre_sum_of_sigma(k: int) -> float:
+
+def build_delta_coefficient_table() -> np.ndarray:
     """
-    Series cache
-    :param k:
+    Delta coefficients `1 / (1 + sum((5 / 7) ** i for i in range(k + 1)))` for k = 0..DELTA_COEFFICIENT_MAX_K,
+    plus the 2/9 asymptote at the last index. The series is accumulated iteratively in one pass.
     :return:
     """
-    # if not isinstance(k, int):
-    #     raise TypeError("k must be an integer")
-    if k < 0:
-        raise ValueError(f"{k=}, pre_sum's index less than zero!")
-    return (5 / 7) ** k + pre_sum_of_sigma(k - 1) if k >= 1 else 1
+    table = np.empty(DELTA_COEFFICIENT_MAX_K + 2, dtype=np.float64)
+    pre_sum = 1
+    for k in range(DELTA_COEFFICIENT_MAX_K + 1):
+        if k >= 1:
+            pre_sum = (5 / 7) ** k + pre_sum
+        table[k] = 1 / (1 + pre_sum)
+    table[DELTA_COEFFICIENT_MAX_K + 1] = 2 / 9
+    table.flags.writeable = False
+    return table
 
 
-@lru_cache
-def adjustment_for_delta_coefficient(k: int) -> float:
-    """
-    This function could also be `return 1 / (1 + sum((5 / 7) ** i for i in range(k + 1)))`
-    but use a `pre_sum_of_sigma` function(which is also cached) is faster.
-    When k is big enough, result approximately equals to 2/9.
-    :param k:
-    :return:
-    """
-    return 1 / (1 + pre_sum_of_sigma(k)) if k <= 100 else 2 / 9
+DELTA_COEFFICIENT_TABLE: Final[np.ndarray] = build_delta_coefficient_table()
 
 
 def delta_coefficients(ks: np.ndarray) -> np.ndarray:
     """
     Calculate delta coefficients for the given input array.
+    A single clipped fancy-index into `DELTA_COEFFICIENT_TABLE`.
     :param ks:
     :return:
     """
-    vectorized_func = np.vectorize(adjustment_for_delta_coefficient)
-    return vectorized_func(ks)
+    ks = np.asarray(ks)
+    if ks.size and ks.min() < 0:
+        raise ValueError(f"{ks.min()=}, pre_sum's index less than zero!")
+    return DELTA_COEFFICIENT_TABLE[
+        np.minimum(ks, DELTA_COEFFICIENT_MAX_K + 1).astype(np.int64)
+    ]
 
 
 @jit(nopython=True, fastmath=True, parallel=True)
@@ -89,18 +90,117 @@ def get_expected_rating(rank: int, rating: float, all_rating: np.ndarray) -> flo
     return binary_search_expected_rating(mean_rank, all_rating)
 
 
-def elo_delta(ranks: np.ndarray, ratings: np.ndarray, ks: np.ndarray) -> np.ndarray:
+@jit(nopython=True, fastmath=True)
+def _sum_of_expected_win_rate(
+    unique_ratings: np.ndarray, rating_counts: np.ndarray, scalar: float
+) -> float:
+    """
+    Scalar-loop version of `np.sum(expected_win_rate(all_rating, scalar))` over compressed ratings,
+    every unique rating contributes its win rate multiplied by how many participants share it.
+    Win rates are calculated in the dtype of `unique_ratings` (float32 in reduced precision mode),
+    but always accumulated in float64.
+    It's meant to be called inside a `prange` body, so it doesn't spawn any threads itself.
+    :param unique_ratings:
+    :param rating_counts:
+    :param scalar:
+    :return:
+    """
+    one = unique_ratings.dtype.type(1)
+    ten = unique_ratings.dtype.type(10)
+    scale = unique_ratings.dtype.type(400)
+    typed_scalar = unique_ratings.dtype.type(scalar)
+    total = 0.0
+    for i in range(unique_ratings.shape[0]):
+        total += rating_counts[i] / (
+            one + ten ** ((typed_scalar - unique_ratings[i]) / scale)
+        )
+    return total
+
+
+@jit(nopython=True, fastmath=True, parallel=True)
+def get_compressed_expected_ratings(
+    ranks: np.ndarray,
+    ratings: np.ndarray,
+    unique_ratings: np.ndarray,
+    rating_counts: np.ndarray,
+) -> np.ndarray:
+    """
+    Solve expected ratings of all participants in one compiled kernel, against the compressed rating population.
+    Participants are dispatched across threads by `prange`, the binary search is the same as
+    `binary_search_expected_rating`, so results are numerically equivalent.
+    :param ranks:
+    :param ratings:
+    :param unique_ratings:
+    :param rating_counts:
+    :return:
+    """
+    n = ranks.shape[0]
+    expected_ratings = np.empty(n, dtype=np.float64)
+    precision: Final[float] = 0.01
+    for i in prange(n):
+        expected_rank = (
+            _sum_of_expected_win_rate(unique_ratings, rating_counts, ratings[i]) + 0.5
+        )
+        target = np.sqrt(expected_rank * ranks[i]) - 1
+        lo, hi = 0.0, 4000.0
+        mid = lo
+        max_iteration = 25
+        while hi - lo > precision and max_iteration >= 0:
+            mid = lo + (hi - lo) / 2
+            if _sum_of_expected_win_rate(unique_ratings, rating_counts, mid) < target:
+                hi = mid
+            else:
+                lo = mid
+            max_iteration -= 1
+        expected_ratings[i] = mid
+    return expected_ratings
+
+
+def get_expected_ratings(
+    ranks: np.ndarray,
+    ratings: np.ndarray,
+    all_rating: np.ndarray,
+    dtype: type = np.float64,
+) -> np.ndarray:
+    """
+    Batch version of `get_expected_rating`.
+    Many participants share the same rating (new users especially), so collapse `all_rating` into unique values
+    with counts, and only solve every distinct (rank, rating) pair once.
+    :param ranks:
+    :param ratings:
+    :param all_rating:
+    :param dtype: np.float32 for reduced precision mode
+    :return:
+    """
+    unique_ratings, rating_counts = np.unique(all_rating, return_counts=True)
+    unique_pairs, inverse = np.unique(
+        np.column_stack((ranks, ratings)).astype(np.float64),
+        axis=0,
+        return_inverse=True,
+    )
+    expected_ratings = get_compressed_expected_ratings(
+        np.ascontiguousarray(unique_pairs[:, 0]),
+        np.ascontiguousarray(unique_pairs[:, 1], dtype=dtype),
+        unique_ratings.astype(dtype),
+        rating_counts.astype(dtype),
+    )
+    return expected_ratings[inverse.reshape(-1)]
+
+
+def elo_delta(
+    ranks: np.ndarray,
+    ratings: np.ndarray,
+    ks: np.ndarray,
+    dtype: type = np.float64,
+) -> np.ndarray:
     """
     Calculate the Elo rating changes (delta) based on the given ranks, current ratings, and coefficients.
     :param ranks:
     :param ratings:
     :param ks:
+    :param dtype: np.float32 for reduced precision mode
     :return:
     """
-    expected_ratings = list()
-    for i in range(len(ranks)):
-        rank = ranks[i]
-        rating = ratings[i]
-        expected_ratings.append(get_expected_rating(rank, rating, ratings))
-    delta_ratings = (np.array(expected_ratings) - ratings) * delta_coefficients(ks)
+    expected_ratings = get_expected_ratings(ranks, ratings, ratings, dtype)
+    delta_ratings = (expected_ratings - ratings) * delta_coefficients(ks)
     return delta_ratings
@@ -1,25 +1,94 @@
-from typing import Final
+import os
+from functools import lru_cache
+from typing import Final, Optional
 
 import numpy as np
+from scipy.fft import irfft, next_fast_len, rfft
 from scipy.signal import fftconvolve
 
 from app.core.elo import delta_coefficients
 
 EXPAND_SIZE: Final[int] = 100
 MAX_RATING: Final[int] = 4000 * EXPAND_SIZE
+# `f` has 2 * MAX_RATING + 1 points and `g` has at most MAX_RATING + 1 points (ratings within [0, 4000]),
+# so a linear convolution fits in this padded length without any wraparound.
+FFT_SIZE: Final[int] = next_fast_len(3 * MAX_RATING + 1, real=True)
 
 
-def pre_calc_convolution(old_rating: np.ndarray) -> np.ndarray:
+@lru_cache
+def get_sigmoid_kernel() -> np.ndarray:
     """
-    Pre-calculate convolution values for the Elo rating update.
-    :param old_rating:
+    The logistic kernel `f` only depends on `MAX_RATING` and `EXPAND_SIZE`, so build it once per process.
     :return:
     """
     f = 1 / (
         1 + np.power(10, np.arange(-MAX_RATING, MAX_RATING + 1) / (400 * EXPAND_SIZE))
     )
-    g = np.bincount(np.round(old_rating * EXPAND_SIZE).astype(int))
-    convolution = fftconvolve(f, g, mode="full")
+    f.flags.writeable = False
+    return f
+
+
+sigmoid_kernel_spectrum: Optional[np.ndarray] = None
+
+
+def get_sigmoid_kernel_spectrum(cache_path: Optional[str] = None) -> np.ndarray:
+    """
+    Real FFT spectrum of the sigmoid kernel at `FFT_SIZE`, built lazily once per process.
+    If `cache_path` is given, load it as a memory-mapped `.npy` file, or build and persist it there.
+    Only the first call decides where the spectrum comes from.
+    :param cache_path:
+    :return:
+    """
+    global sigmoid_kernel_spectrum
+    if sigmoid_kernel_spectrum is not None:
+        return sigmoid_kernel_spectrum
+    if cache_path is not None and os.path.exists(cache_path):
+        spectrum = np.load(cache_path, mmap_mode="r")
+        if spectrum.shape == (FFT_SIZE // 2 + 1,):
+            sigmoid_kernel_spectrum = spectrum
+            return sigmoid_kernel_spectrum
+    spectrum = rfft(get_sigmoid_kernel(), FFT_SIZE)
+    if cache_path is not None:
+        np.save(cache_path, spectrum)
+    spectrum.flags.writeable = False
+    sigmoid_kernel_spectrum = spectrum
+    return sigmoid_kernel_spectrum
+
+
+@lru_cache
+def get_single_precision_sigmoid_kernel_spectrum() -> np.ndarray:
+    """
+    complex64 copy of the kernel spectrum for reduced precision mode, half the memory bandwidth.
+    :return:
+    """
+    spectrum = get_sigmoid_kernel_spectrum().astype(np.complex64)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+def pre_calc_convolution(
+    old_rating: np.ndarray,
+    dtype: type = np.float64,
+) -> np.ndarray:
+    """
+    Pre-calculate convolution values for the Elo rating update.
+    Only the rating histogram `g` is transformed here, the kernel spectrum is cached.
+    With `dtype=np.float32`, transforms run in single precision.
+    :param old_rating:
+    :param dtype: np.float32 for reduced precision mode
+    :return:
+    """
+    g = np.bincount(np.round(old_rating * EXPAND_SIZE).astype(int)).astype(dtype)
+    if len(g) > MAX_RATING + 1:
+        # out of the padded length, very unlikely to happen, fall back to transform both sides
+        convolution = fftconvolve(get_sigmoid_kernel().astype(dtype), g, mode="full")
+    else:
+        spectrum = (
+            get_single_precision_sigmoid_kernel_spectrum()
+            if dtype == np.float32
+            else get_sigmoid_kernel_spectrum()
+        )
+        convolution = irfft(spectrum * rfft(g, FFT_SIZE), FFT_SIZE)
     convolution = convolution[: 2 * MAX_RATING + 1]
     return convolution
 
@@ -74,19 +143,45 @@ def get_expected_rating(rank: int, rating: float, convolution: np.ndarray) -> fl
     return binary_search_expected_rating(convolution, mean_rank) / EXPAND_SIZE
 
 
-def fft_delta(ranks: np.ndarray, ratings: np.ndarray, ks: np.ndarray) -> np.ndarray:
+def get_expected_ratings(
+    ranks: np.ndarray, ratings: np.ndarray, convolution: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized version of `get_expected_rating` for all participants.
+    The equation left side is monotonically decreasing in x, so instead of a binary search per participant,
+    all mean ranks are inverted by a single `np.searchsorted` over the negated array.
+    :param ranks:
+    :param ratings:
+    :param convolution:
+    :return:
+    """
+    expected_ranks = (
+        convolution[np.round(ratings * EXPAND_SIZE).astype(int) + MAX_RATING] + 0.5
+    )
+    mean_ranks = np.sqrt(expected_ranks * ranks)
+    # negate to get an ascending array, then the first x that `equation_left < mean_rank` is the insertion point
+    negative_equation_left = -(convolution[MAX_RATING:-1] + 1)
+    expected_ratings = np.searchsorted(
+        negative_equation_left, -mean_ranks, side="right"
+    )
+    return expected_ratings / EXPAND_SIZE
+
+
+def fft_delta(
+    ranks: np.ndarray,
+    ratings: np.ndarray,
+    ks: np.ndarray,
+    dtype: type = np.float64,
+) -> np.ndarray:
     """
     Calculate Elo rating changes using Fast Fourier Transform (FFT)
     :param ranks:
     :param ratings:
     :param ks:
+    :param dtype: np.float32 for reduced precision mode
     :return:
     """
-    convolution = pre_calc_convolution(ratings)
-    expected_ratings = list()
-    for i in range(len(ranks)):
-        rank = ranks[i]
-        rating = ratings[i]
-        expected_ratings.append(get_expected_rating(rank, rating, convolution))
-    delta_ratings = (np.array(expected_ratings) - ratings) * delta_coefficients(ks)
+    convolution = pre_calc_convolution(ratings, dtype)
+    expected_ratings = get_expected_ratings(ranks, ratings, convolution)
+    delta_ratings = (expected_ratings - ratings) * delta_coefficients(ks)
     return delta_ratings
@@ -1,41 +1,231 @@
+import time
 from datetime import datetime
-from typing import List
+from typing import Callable, Dict, Final, List, Literal, NamedTuple, Optional, Tuple
 
 import numpy as np
 from beanie.odm.operators.update.general import Set
 from loguru import logger
+from pymongo import UpdateOne
 
-from app.core.elo import elo_delta
+from app.config import get_yaml_config
+from app.constants import RATING_DELTA_PRECISION
+from app.core.elo import delta_coefficients, elo_delta, get_expected_ratings
+from app.core.fft import EXPAND_SIZE, fft_delta
+from app.core.fft import get_expected_ratings as fft_get_expected_ratings
+from app.core.fft import get_sigmoid_kernel_spectrum, pre_calc_convolution
 from app.db.models import Contest, ContestRecordPredict, User
-from app.utils import exception_logger_reraise, gather_with_limited_concurrency
+from app.db.mongodb import bulk_write_in_batches, get_async_mongodb_collection
+from app.utils import exception_logger_reraise
+
+PREDICTION_ENGINE = Literal["elo", "fft", "auto"]
+PREDICTION_ENGINES: Final[Dict[str, Callable[..., np.ndarray]]] = {
+    "elo": elo_delta,
+    "fft": fft_delta,
+}
+# Measured on synthetic contests: the O(n^2) elo engine beats the FFT engine's constant cost (~0.06s)
+# below roughly 750 participants on a single core, and proportionally more with additional cores.
+AUTO_ENGINE_CROSSOVER_USER_NUM: Final[int] = 1000
+EXACT_CHECK_SAMPLE_SIZE: Final[int] = 100
+
+
+def get_predictor_config() -> Dict:
+    """
+    Get predictor config in `config.yaml`, missing section means default settings
+    :return:
+    """
+    return get_yaml_config().get("predictor") or dict()
+
+
+def warm_up_sigmoid_kernel_spectrum() -> None:
+    """
+    Load the kernel spectrum from `predictor.fft_kernel_cache` in `config.yaml` if configured.
+    Must run before any other `get_sigmoid_kernel_spectrum` call, the first call decides where it comes from.
+    :return:
+    """
+    get_sigmoid_kernel_spectrum(get_predictor_config().get("fft_kernel_cache"))
+
+
+def select_prediction_engine(
+    engine: PREDICTION_ENGINE,
+    user_num: int,
+) -> str:
+    """
+    Resolve `auto` to a concrete engine by participant count
+    :param engine:
+    :param user_num:
+    :return:
+    """
+    if engine == "auto":
+        return "elo" if user_num < AUTO_ENGINE_CROSSOVER_USER_NUM else "fft"
+    if engine not in PREDICTION_ENGINES:
+        raise ValueError(f"unknown prediction {engine=}")
+    return engine
+
+
+def sampled_exact_deviation(
+    rank_array: np.ndarray,
+    rating_array: np.ndarray,
+    k_array: np.ndarray,
+    delta_rating_array: np.ndarray,
+    sample_size: int = EXACT_CHECK_SAMPLE_SIZE,
+) -> float:
+    """
+    Max deviation of `delta_rating_array` from the exact elo result on a random sample of participants
+    :param rank_array:
+    :param rating_array:
+    :param k_array:
+    :param delta_rating_array:
+    :param sample_size:
+    :return:
+    """
+    if len(rank_array) == 0:
+        return 0.0
+    sampled = np.random.default_rng().choice(
+        len(rank_array), size=min(sample_size, len(rank_array)), replace=False
+    )
+    ratings = np.ascontiguousarray(rating_array, dtype=np.float64)
+    expected_ratings = get_expected_ratings(
+        np.ascontiguousarray(rank_array[sampled], dtype=np.float64),
+        ratings[sampled],
+        ratings,
+    )
+    exact_delta_ratings = (expected_ratings - ratings[sampled]) * delta_coefficients(
+        k_array[sampled]
+    )
+    return float(np.max(np.abs(exact_delta_ratings - delta_rating_array[sampled])))
+
+
+def run_prediction_engine(
+    rank_array: np.ndarray,
+    rating_array: np.ndarray,
+    k_array: np.ndarray,
+) -> np.ndarray:
+    """
+    Run the engine set by `predictor.engine` in `config.yaml`, log its wall time and sampled deviation.
+    When `predictor.reduced_precision` is enabled, run in float32 first, then fall back to float64
+    if the sampled exact check exceeds `RATING_DELTA_PRECISION`.
+    :param rank_array:
+    :param rating_array:
+    :param k_array:
+    :return:
+    """
+    predictor_config = get_predictor_config()
+    engine = select_prediction_engine(
+        predictor_config.get("engine", "elo"), len(rank_array)
+    )
+    if engine == "fft":
+        warm_up_sigmoid_kernel_spectrum()
+    dtypes = (
+        [np.float32, np.float64]
+        if predictor_config.get("reduced_precision", False)
+        else [np.float64]
+    )
+    for dtype in dtypes:
+        t1 = time.time()
+        delta_rating_array = PREDICTION_ENGINES[engine](
+            rank_array, rating_array, k_array, dtype
+        )
+        t2 = time.time()
+        if engine == "elo" and dtype == np.float64:
+            # elo engine is the exact one, no need to check
+            max_deviation = 0.0
+        else:
+            max_deviation = sampled_exact_deviation(
+                rank_array, rating_array, k_array, delta_rating_array
+            )
+        logger.info(
+            f"{engine=} dtype={dtype.__name__} user_num={len(rank_array)} cost {t2 - t1:.2f}s "
+            f"max_deviation={max_deviation:.4f} from sampled exact check"
+        )
+        if max_deviation < RATING_DELTA_PRECISION:
+            break
+        logger.warning(f"{max_deviation=} exceeds {RATING_DELTA_PRECISION=}")
+    return delta_rating_array
+
+
+class PredictionInputs(NamedTuple):
+    ids: np.ndarray
+    ranks: np.ndarray
+    ratings: np.ndarray
+    ks: np.ndarray
+
+
+async def load_prediction_inputs(
+    contest_name: str,
+    batch_size: int = 10000,
+) -> PredictionInputs:
+    """
+    Columnar loader of prediction inputs, stream only needed fields through a raw cursor with projection
+    into preallocated arrays, no document model is constructed for any row.
+    :param contest_name:
+    :param batch_size: cursor batch size
+    :return:
+    """
+    col = get_async_mongodb_collection(ContestRecordPredict.__name__)
+    query = {"contest_name": contest_name, "score": {"$ne": 0}}
+    user_num = await col.count_documents(query)
+    ids = np.empty(user_num, dtype=object)
+    ranks = np.empty(user_num, dtype=np.int64)
+    ratings = np.empty(user_num, dtype=np.float64)
+    ks = np.empty(user_num, dtype=np.int64)
+    i = 0
+    cursor = col.find(
+        query,
+        {"_id": 1, "rank": 1, "old_rating": 1, "attendedContestsCount": 1},
+        sort=[("rank", 1)],
+        batch_size=batch_size,
+    )
+    async for doc in cursor:
+        if i == user_num:
+            logger.warning(f"more records than counted {user_num=}, ignore the rest")
+            break
+        ids[i] = doc["_id"]
+        ranks[i] = doc["rank"]
+        ratings[i] = doc["old_rating"]
+        ks[i] = doc["attendedContestsCount"]
+        i += 1
+    return PredictionInputs(
+        ids=ids[:i], ranks=ranks[:i], ratings=ratings[:i], ks=ks[:i]
+    )
 
 
 async def update_rating_immediately(
-    records: List[ContestRecordPredict],
+    contest_name: str,
 ) -> None:
     """
     Update users' rating and attendedContestsCount (if it's biweekly contest)
-    :param records:
+    Read predicted results back with projection, then write them into User collection by bulk updates.
+    :param contest_name:
     :return:
     """
     logger.info("immediately write predicted result back into User collection")
-    tasks = [
-        User.find_one(
-            User.username == record.username,
-            User.data_region == record.data_region,
-        ).update(
-            Set(
-                {
-                    User.rating: record.new_rating,
-                    User.attendedContestsCount: record.attendedContestsCount + 1,
-                    User.update_time: datetime.utcnow(),
+    col = get_async_mongodb_collection(ContestRecordPredict.__name__)
+    update_time = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"username": doc["username"], "data_region": doc["data_region"]},
+            {
+                "$set": {
+                    "rating": doc["new_rating"],
+                    "attendedContestsCount": doc["attendedContestsCount"] + 1,
+                    "update_time": update_time,
                 }
-            )
+            },
+        )
+        async for doc in col.find(
+            {"contest_name": contest_name, "score": {"$ne": 0}},
+            {
+                "_id": 0,
+                "username": 1,
+                "data_region": 1,
+                "new_rating": 1,
+                "attendedContestsCount": 1,
+            },
+            batch_size=10000,
         )
-        for record in records
     ]
-    await gather_with_limited_concurrency(tasks, max_con_num=50)
-    logger.success("finished updating User using predicted result")
+    error_num = await bulk_write_in_batches(User.__name__, operations)
+    logger.success(f"finished updating User using predicted result {error_num=}")
 
 
 @exception_logger_reraise
@@ -47,35 +237,36 @@ async def predict_contest(
     :param contest_name:
     :return:
     """
-    records = (
-        await ContestRecordPredict.find(
-            ContestRecordPredict.contest_name == contest_name,
-            ContestRecordPredict.score != 0,
-        )
-        .sort(ContestRecordPredict.rank)
-        .to_list()
-    )
-
-    rank_array = np.array([record.rank for record in records])
-    rating_array = np.array([record.old_rating for record in records])
-    k_array = np.array([record.attendedContestsCount for record in records])
+    inputs = await load_prediction_inputs(contest_name)
     # core prediction
-    delta_rating_array = elo_delta(rank_array, rating_array, k_array)
-    new_rating_array = rating_array + delta_rating_array
+    delta_rating_array = run_prediction_engine(inputs.ranks, inputs.ratings, inputs.ks)
+    new_rating_array = inputs.ratings + delta_rating_array
 
     # update ContestRecordPredict collection
     predict_time = datetime.utcnow()
-    for i, record in enumerate(records):
-        record.delta_rating = delta_rating_array[i]
-        record.new_rating = new_rating_array[i]
-        record.predict_time = predict_time
-    tasks = [record.save() for record in records]
-    await gather_with_limited_concurrency(tasks, max_con_num=50)
-    logger.success("predict_contest finished updating ContestRecordPredict")
+    operations = [
+        UpdateOne(
+            {"_id": _id},
+            {
+                "$set": {
+                    "delta_rating": float(delta_rating),
+                    "new_rating": float(new_rating),
+                    "predict_time": predict_time,
+                }
+            },
+        )
+        for _id, delta_rating, new_rating in zip(
+            inputs.ids, delta_rating_array, new_rating_array
+        )
+    ]
+    error_num = await bulk_write_in_batches(ContestRecordPredict.__name__, operations)
+    logger.success(
+        f"predict_contest finished updating ContestRecordPredict {error_num=}"
+    )
 
     if contest_name.lower().startswith("bi"):
         # for biweekly contests only, because next day's weekly contest needs the latest rating
-        await update_rating_immediately(records)
+        await update_rating_immediately(contest_name)
 
     # update Contest collection to indicate that this contest has been predicted.
     # by design, predictions should only be run once.
@@ -87,3 +278,79 @@ async def predict_contest(
         )
     )
     logger.info("finished updating predict_time in Contest database")
+    # live prediction is over once the final prediction is done
+    live_prediction_states.pop(contest_name, None)
+
+
+class LivePredictionState(NamedTuple):
+    # rating histogram which the convolution was calculated from
+    histogram: np.ndarray
+    convolution: np.ndarray
+    # (username, data_region) -> (old_rating, attendedContestsCount), only ratings found in User collection
+    user_ratings: Dict[Tuple[str, str], Tuple[float, int]]
+    # (username, data_region) -> (rank, delta_rating) of the last live prediction run
+    solved: Dict[Tuple[str, str], Tuple[int, float]]
+    # (username, data_region) of all rows written in `ContestRecordProvisional` by the last run
+    saved_keys: set[Tuple[str, str]]
+
+
+live_prediction_states: Dict[str, LivePredictionState] = dict()
+
+
+def solve_live_records(
+    contest_name: str,
+    contest_records: List[Dict],
+    state: Optional[LivePredictionState],
+) -> Tuple[np.ndarray, np.ndarray, Dict[Tuple[str, str], Tuple[int, float]], List]:
+    """
+    Reuse the previous convolution if rating population didn't change, then only re-solve users whose rank moved.
+    Solved records get their `delta_rating` and `new_rating` filled.
+    :param contest_name:
+    :param contest_records: records with `old_rating` and `attendedContestsCount` filled
+    :param state: state of the last run, None if there isn't or it can't be reused
+    :return: histogram, convolution, solved and the re-solved records
+    """
+    rank_array = np.array([record["rank"] for record in contest_records])
+    rating_array = np.array([record["old_rating"] for record in contest_records])
+    k_array = np.array([record["attendedContestsCount"] for record in contest_records])
+    histogram = np.bincount(np.round(rating_array * EXPAND_SIZE).astype(int))
+    reused_convolution = state is not None and np.array_equal(
+        state.histogram, histogram
+    )
+    if reused_convolution:
+        convolution = state.convolution
+        solved = state.solved
+    else:
+        warm_up_sigmoid_kernel_spectrum()
+        convolution = pre_calc_convolution(rating_array)
+        solved = dict()
+    solving_indexes = np.array(
+        [
+            i
+            for i, record in enumerate(contest_records)
+            if solved.get((record["username"], record["data_region"]), (None,))[0]
+            != record["rank"]
+        ],
+        dtype=int,
+    )
+    expected_ratings = fft_get_expected_ratings(
+        rank_array[solving_indexes], rating_array[solving_indexes], convolution
+    )
+    delta_rating_array = (
+        expected_ratings - rating_array[solving_indexes]
+    ) * delta_coefficients(k_array[solving_indexes])
+    logger.info(
+        f"{contest_name=} live prediction re-solved {len(solving_indexes)}/{len(contest_records)} users, "
+        f"{reused_convolution=}"
+    )
+    solved_records = list()
+    for i, delta_rating in zip(solving_indexes, delta_rating_array):
+        record = contest_records[i]
+        record["delta_rating"] = float(delta_rating)
+        record["new_rating"] = record["old_rating"] + record["delta_rating"]
+        solved[(record["username"], record["data_region"])] = (
+            record["rank"],
+            record["delta_rating"],
+        )
+        solved_records.append(record)
+    return histogram, convolution, solved, solved_records
@@ -0,0 +1,220 @@
+import sqlite3
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, NamedTuple, Optional
+
+from loguru import logger
+
+from app.crawler.utils import get_http_config
+from app.db.models import DATA_REGION
+from app.utils import get_contest_start_time
+
+crawl_cache_connection: Optional[sqlite3.Connection] = None
+
+
+class CachedPage(NamedTuple):
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+def get_crawl_cache_config() -> Dict:
+    """
+    Get `crawl_cache` in http config, cache is disabled without `path`
+    :return:
+    """
+    return get_http_config().get("crawl_cache") or dict()
+
+
+def get_crawl_cache_connection() -> Optional[sqlite3.Connection]:
+    """
+    SQLite connection of the local crawl cache, opened once per process.
+    :return: None if cache is disabled
+    """
+    global crawl_cache_connection
+    if crawl_cache_connection is None:
+        if (path := get_crawl_cache_config().get("path")) is None:
+            return None
+        crawl_cache_connection = sqlite3.connect(path)
+        crawl_cache_connection.execute("PRAGMA journal_mode=WAL")
+        crawl_cache_connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ranking_page (
+                data_region TEXT NOT NULL,
+                contest_name TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                content BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (data_region, contest_name, page)
+            )
+            """
+        )
+        logger.info(f"opened crawl cache {path=}")
+    return crawl_cache_connection
+
+
+def close_crawl_cache() -> None:
+    """
+    Close the crawl cache when process exits.
+    :return:
+    """
+    global crawl_cache_connection
+    if crawl_cache_connection is not None:
+        crawl_cache_connection.close()
+        crawl_cache_connection = None
+
+
+def load_cached_page(
+    data_region: DATA_REGION,
+    contest_name: str,
+    page: int,
+) -> Optional[CachedPage]:
+    """
+    Load a cached ranking page, `page = 0` is the first request without pagination
+    :param data_region:
+    :param contest_name:
+    :param page:
+    :return:
+    """
+    if (connection := get_crawl_cache_connection()) is None:
+        return None
+    row = connection.execute(
+        "SELECT content, etag, last_modified, fetched_at FROM ranking_page "
+        "WHERE data_region = ? AND contest_name = ? AND page = ?",
+        (data_region, contest_name, page),
+    ).fetchone()
+    if row is None:
+        return None
+    content, etag, last_modified, fetched_at = row
+    return CachedPage(zlib.decompress(content), etag, last_modified, fetched_at)
+
+
+def save_cached_page(
+    data_region: DATA_REGION,
+    contest_name: str,
+    page: int,
+    content: bytes,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+) -> None:
+    """
+    Save a ranking page as soon as it's fetched, committed one by one so that an interrupted crawl can resume
+    :param data_region:
+    :param contest_name:
+    :param page:
+    :param content:
+    :param etag:
+    :param last_modified:
+    :return:
+    """
+    if (connection := get_crawl_cache_connection()) is None:
+        return
+    connection.execute(
+        "INSERT OR REPLACE INTO ranking_page VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            data_region,
+            contest_name,
+            page,
+            zlib.compress(content),
+            etag,
+            last_modified,
+            time.time(),
+        ),
+    )
+    connection.commit()
+
+
+def touch_cached_page(
+    data_region: DATA_REGION,
+    contest_name: str,
+    page: int,
+) -> None:
+    """
+    Server says the page is not modified, restart its TTL
+    :param data_region:
+    :param contest_name:
+    :param page:
+    :return:
+    """
+    if (connection := get_crawl_cache_connection()) is None:
+        return
+    connection.execute(
+        "UPDATE ranking_page SET fetched_at = ? "
+        "WHERE data_region = ? AND contest_name = ? AND page = ?",
+        (time.time(), data_region, contest_name, page),
+    )
+    connection.commit()
+
+
+def get_contest_end_time(contest_name: str) -> datetime:
+    """
+    End time of a contest in UTC, every contest lasts 90 minutes
+    :param contest_name:
+    :return:
+    """
+    return get_contest_start_time(contest_name) + timedelta(minutes=90)
+
+
+def get_contest_final_timestamp(contest_name: str) -> float:
+    """
+    Rejudging only happens in the first few days after a contest, after that its ranking never changes.
+    `final_after_days` defaults to 7 so that the Wednesday to Saturday reruns of `save_last_two_contest_records`
+    (up to about 6.3 days after a contest) always revalidate pages and can see rejudges.
+    :param contest_name:
+    :return: unix timestamp after which ranking of this contest is final
+    """
+    final_after = timedelta(days=get_crawl_cache_config().get("final_after_days", 7))
+    return (
+        (get_contest_end_time(contest_name) + final_after)
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
+
+def evict_expired_cached_contests() -> None:
+    """
+    Remove pages of contests which ended more than `keep_days` ago.
+    They are out of the archive window of `save_last_two_contest_records` (up to about 13.3 days for a biweekly
+    contest in its off week), schedulers won't crawl them again.
+    :return:
+    """
+    if (connection := get_crawl_cache_connection()) is None:
+        return
+    expired_before = datetime.utcnow() - timedelta(
+        days=get_crawl_cache_config().get("keep_days", 14)
+    )
+    expired_contest_names = [
+        contest_name
+        for (contest_name,) in connection.execute(
+            "SELECT DISTINCT contest_name FROM ranking_page"
+        )
+        if get_contest_end_time(contest_name) < expired_before
+    ]
+    connection.executemany(
+        "DELETE FROM ranking_page WHERE contest_name = ?",
+        [(contest_name,) for contest_name in expired_contest_names],
+    )
+    connection.commit()
+    logger.info(f"evicted cached pages of {expired_contest_names=}")
+
+
+def is_cached_page_fresh(
+    contest_name: str,
+    cached_page: CachedPage,
+) -> bool:
+    """
+    Pages fetched after the ranking became final are always fresh,
+    others are fresh within `ttl` seconds after fetched or revalidated.
+    :param contest_name:
+    :param cached_page:
+    :return:
+    """
+    if cached_page.fetched_at >= get_contest_final_timestamp(contest_name):
+        return True
+    return time.time() - cached_page.fetched_at < get_crawl_cache_config().get(
+        "ttl", 3600
+    )
@@ -1,54 +1,188 @@
 from math import ceil
-from typing import Dict, Final, List, Tuple
+from typing import AsyncIterator, Dict, Final, List, Optional, Tuple
 
+import httpx
 from loguru import logger
 
-from app.crawler.utils import multi_http_request
+from app.crawler.cache import (
+    CachedPage,
+    is_cached_page_fresh,
+    load_cached_page,
+    save_cached_page,
+    touch_cached_page,
+)
+from app.crawler.utils import json_loads, multi_http_request_stream
 from app.db.models import DATA_REGION
 
 
+def get_ranking_page_request(
+    url: str,
+    cached_page: Optional[CachedPage] = None,
+) -> Dict:
+    """
+    Request of a ranking page, conditional on `ETag` / `Last-Modified` of a stale cached page
+    :param url:
+    :param cached_page:
+    :return:
+    """
+    request = {"url": url, "method": "GET"}
+    if cached_page is not None:
+        headers = dict()
+        if cached_page.etag:
+            headers["If-None-Match"] = cached_page.etag
+        if cached_page.last_modified:
+            headers["If-Modified-Since"] = cached_page.last_modified
+        request["headers"] = headers
+    return request
+
+
+def decode_ranking_page(response: httpx.Response) -> Tuple[httpx.Response, Dict | None]:
+    """
+    Decode here so that a broken page is retried, body is kept only for saving into cache
+    :param response:
+    :return: response and parsed page, None if not modified
+    """
+    if response.status_code == 304:
+        return response, None
+    return response, json_loads(response.content)
+
+
+def handle_ranking_page_response(
+    contest_name: str,
+    data_region: DATA_REGION,
+    page: int,
+    response: httpx.Response,
+    data: Dict | None,
+    cached_page: Optional[CachedPage],
+    use_cache: bool,
+) -> Dict:
+    """
+    Not modified response restarts TTL of the cached page, otherwise the fetched page is saved into cache
+    :param contest_name:
+    :param data_region:
+    :param page:
+    :param response:
+    :param data: parsed page
+    :param cached_page: the stale cached page which was revalidated
+    :param use_cache:
+    :return: parsed page
+    """
+    if response.status_code == 304:
+        touch_cached_page(data_region, contest_name, page)
+        return json_loads(cached_page.content)
+    if use_cache:
+        save_cached_page(
+            data_region,
+            contest_name,
+            page,
+            response.content,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+    return data
+
+
+async def request_ranking_pages(
+    contest_name: str,
+    data_region: DATA_REGION,
+    page_urls: Dict[int, str],
+    use_cache: bool = False,
+) -> AsyncIterator[Tuple[int, Dict | None]]:
+    """
+    Yield parsed ranking pages as soon as each one is ready.
+    With `use_cache`, fresh pages come from the local crawl cache, stale ones are revalidated by
+    `If-None-Match` / `If-Modified-Since`, and every fetched page is saved immediately,
+    so that a crawl interrupted halfway resumes from where it stopped.
+    :param contest_name:
+    :param data_region:
+    :param page_urls: page number to url, `0` is the first request without pagination
+    :param use_cache:
+    :return: page number and parsed page, None if HTTP request failed
+    """
+    cached_pages = dict()
+    multi_requests = dict()
+    for page, url in page_urls.items():
+        cached_page = (
+            load_cached_page(data_region, contest_name, page) if use_cache else None
+        )
+        if cached_page is not None and is_cached_page_fresh(contest_name, cached_page):
+            yield page, json_loads(cached_page.content)
+            continue
+        if cached_page is not None:
+            cached_pages[page] = cached_page
+        multi_requests[page] = get_ranking_page_request(url, cached_page)
+    logger.info(
+        f"{len(page_urls)=} cache_hit_num={len(page_urls) - len(multi_requests)} "
+        f"revalidate_num={len(cached_pages)}"
+    )
+    async for page, result in multi_http_request_stream(
+        multi_requests,
+        concurrent_num=5 if data_region == "US" else 10,
+        parse=decode_ranking_page,
+        success_status_codes=(200, 304),
+    ):
+        if result is None:
+            yield page, None
+            continue
+        response, data = result
+        yield page, handle_ranking_page_response(
+            contest_name,
+            data_region,
+            page,
+            response,
+            data,
+            cached_pages.get(page),
+            use_cache,
+        )
+
+
 async def request_contest_records(
     contest_name: str,
     data_region: DATA_REGION,
+    use_cache: bool = False,
 ) -> Tuple[List[Dict], List[Dict]]:
     """
     Fetch all ranking records of a contest by sending http request per page concurrently
     :param contest_name:
     :param data_region:
+    :param use_cache: use local crawl cache, only for archiving, live and predicting data must be fresh
     :return:
     """
     base_url: Final[str] = (
         "https://leetcode.com" if data_region == "US" else "https://leetcode.cn"
     )
     logger.info(f"start {base_url=}")
-    req = (
-        await multi_http_request(
-            {
-                "req": {
-                    "url": f"{base_url}/contest/api/ranking/{contest_name}/",
-                    "method": "GET",
-                }
-            }
-        )
-    )[0]
-    data = req.json()
-    user_num = data.get("user_num")
+    async for _, data in request_ranking_pages(
+        contest_name,
+        data_region,
+        {0: f"{base_url}/contest/api/ranking/{contest_name}/"},
+        use_cache,
+    ):
+        if data is None:
+            raise RuntimeError(f"failed to request ranking of {contest_name=}")
+        user_num = data.get("user_num")
     page_max = ceil(user_num / 25)
     contest_record_list = list()
     nested_submission_list = list()
-    url_list = [
-        f"{base_url}/contest/api/ranking/{contest_name}/?pagination={page}&region=global"
-        for page in range(1, page_max + 1)
-    ]
-    responses = await multi_http_request(
-        {url: {"url": url, "method": "GET"} for url in url_list},
-        concurrent_num=5 if data_region == "US" else 10,
-    )
-    for res in responses:
-        if res is None:
-            continue
-        res_dict = res.json()
-        contest_record_list.extend(res_dict.get("total_rank"))
-        nested_submission_list.extend(res_dict.get("submissions"))
+    # parse every page as soon as it arrives, raw bodies are never accumulated.
+    # pages arriving early wait in `arrived_pages`, records are extended in page order,
+    # so that the first one of duplicated records during a contest is always from the earlier page.
+    arrived_pages: Dict[int, Dict | None] = dict()
+    next_page = 1
+    async for page, res_dict in request_ranking_pages(
+        contest_name,
+        data_region,
+        {
+            page: f"{base_url}/contest/api/ranking/{contest_name}/?pagination={page}&region=global"
+            for page in range(1, page_max + 1)
+        },
+        use_cache,
+    ):
+        arrived_pages[page] = res_dict
+        while next_page in arrived_pages:
+            if (res_dict := arrived_pages.pop(next_page)) is not None:
+                contest_record_list.extend(res_dict.get("total_rank"))
+                nested_submission_list.extend(res_dict.get("submissions"))
+            next_page += 1
     logger.success("finished")
     return contest_record_list, nested_submission_list
@@ -1,67 +1,251 @@
-from typing import Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
 
-from app.crawler.utils import multi_http_request
+from loguru import logger
+
+from app.crawler.utils import get_http_config, multi_http_request_stream
 from app.db.models import DATA_REGION
 
 
-async def request_user_rating_and_attended_contests_count(
+def get_users_contest_history_request(
     data_region: DATA_REGION,
-    username: str,
-) -> Tuple[float | None, int | None]:
+    usernames: Sequence[str],
+) -> Dict:
     """
-    request user's rating, attended contests count
+    Pack many users' contest history into one GraphQL request, every user is an aliased
+    `userContestRankingHistory` field `u{i}`, the rating of every attended contest is the rating after it.
     :param data_region:
-    :param username:
+    :param usernames:
     :return:
     """
-    if data_region == "CN":
-        req = (
-            await multi_http_request(
-                {
-                    (data_region, username): {
-                        "url": "https://leetcode.cn/graphql/noj-go/",
-                        "method": "POST",
-                        "json": {
-                            "query": """
-                                 query userContestRankingInfo($userSlug: String!) {
-                                        userContestRanking(userSlug: $userSlug) {
-                                            attendedContestsCount
-                                            rating
-                                        }
-                                    }
-                                 """,
-                            "variables": {"userSlug": username},
-                        },
-                    }
-                }
-            )
-        )[0]
-    else:
-        req = (
-            await multi_http_request(
-                {
-                    (data_region, username): {
-                        "url": "https://leetcode.com/graphql/",
-                        "method": "POST",
-                        "json": {
-                            "query": """
-                                 query getContestRankingData($username: String!) {
-                                    userContestRanking(username: $username) {
-                                        attendedContestsCount
-                                        rating
-                                    }
-                                 }
-                                 """,
-                            "variables": {"username": username},
-                        },
-                    }
-                }
+    argument = "userSlug" if data_region == "CN" else "username"
+    variables = {f"u{i}": username for i, username in enumerate(usernames)}
+    declarations = ", ".join(f"${alias}: String!" for alias in variables)
+    fields = " ".join(
+        f"{alias}: userContestRankingHistory({argument}: ${alias}) "
+        "{ attended rating ranking finishTimeInSeconds contest { title } }"
+        for alias in variables
+    )
+    return {
+        "url": (
+            "https://leetcode.cn/graphql/noj-go/"
+            if data_region == "CN"
+            else "https://leetcode.com/graphql/"
+        ),
+        "method": "POST",
+        "json": {
+            "query": f"query usersContestRankingHistory({declarations}) {{ {fields} }}",
+            "variables": variables,
+        },
+    }
+
+
+def parse_users_contest_history(
+    graphql_payload: Dict,
+    usernames: Sequence[str],
+) -> Optional[Dict[str, List[Dict]]]:
+    """
+    Map aliased fields back to users, keep attended contests in the shape of `UserContestHistoryRecord`.
+    A missing or null field means no contest history.
+    :param graphql_payload:
+    :param usernames:
+    :return: None if the whole batch failed
+    """
+    if (data := graphql_payload.get("data")) is None:
+        return None
+    return {
+        username: [
+            {
+                "contest_title": record["contest"]["title"],
+                "finishTimeInSeconds": record["finishTimeInSeconds"],
+                "rating": record["rating"],
+                "ranking": record["ranking"],
+            }
+            for record in data.get(f"u{i}") or list()
+            if record.get("attended")
+        ]
+        for i, username in enumerate(usernames)
+    }
+
+
+def get_users_rating_request(
+    data_region: DATA_REGION,
+    usernames: Sequence[str],
+) -> Dict:
+    """
+    Pack many users into one GraphQL request, every user is an aliased `userContestRanking` field `u{i}`
+    :param data_region:
+    :param usernames:
+    :return:
+    """
+    argument = "userSlug" if data_region == "CN" else "username"
+    variables = {f"u{i}": username for i, username in enumerate(usernames)}
+    declarations = ", ".join(f"${alias}: String!" for alias in variables)
+    fields = " ".join(
+        f"{alias}: userContestRanking({argument}: ${alias}) {{ attendedContestsCount rating }}"
+        for alias in variables
+    )
+    return {
+        "url": (
+            "https://leetcode.cn/graphql/noj-go/"
+            if data_region == "CN"
+            else "https://leetcode.com/graphql/"
+        ),
+        "method": "POST",
+        "json": {
+            "query": f"query usersContestRanking({declarations}) {{ {fields} }}",
+            "variables": variables,
+        },
+    }
+
+
+def parse_users_rating(
+    graphql_payload: Dict,
+    usernames: Sequence[str],
+) -> Optional[Dict[str, Tuple[float | None, int | None]]]:
+    """
+    Map aliased fields back to users, a missing or null field means that it cannot request information about
+    this user, it should be a new user.
+    :param graphql_payload:
+    :param usernames:
+    :return: None if the whole batch failed
+    """
+    if (data := graphql_payload.get("data")) is None:
+        return None
+    results = dict()
+    for i, username in enumerate(usernames):
+        if (graphql_res := data.get(f"u{i}")) is None:
+            results[username] = (None, None)
+        else:
+            results[username] = (
+                graphql_res.get("rating"),
+                graphql_res.get("attendedContestsCount"),
             )
-        )[0]
-    if req is None:
-        raise RuntimeError(f"HTTP request failed for {data_region=} {username=}")
-    if (graphql_res := req.json().get("data", {}).get("userContestRanking")) is None:
-        # Watch out: `None` means that it cannot request information about this user, it should be a new user.
-        return None, None
-    else:
-        return graphql_res.get("rating"), graphql_res.get("attendedContestsCount")
+    return results
+
+
+def split_into_batches(
+    usernames: Sequence[str],
+    batch_size: int,
+) -> List[Tuple[str, ...]]:
+    """
+    Split users into batches of at most `batch_size` users
+    :param usernames:
+    :param batch_size:
+    :return:
+    """
+    batches = list()
+    for i in range(0, len(usernames), batch_size):
+        j = i + batch_size
+        batches.append(tuple(usernames[i:j]))
+    return batches
+
+
+def is_batch_payload_failed(
+    graphql_payload: Dict,
+    results: Optional[Dict],
+    batch: Tuple[str, ...],
+) -> bool:
+    """
+    A batch fails on payload level when `data` is missing, or GraphQL reports errors for some of its users.
+    A single user can't be split anymore, its null field means a new user, missing `data` means a failed user.
+    :param graphql_payload:
+    :param results: parsed results of the batch
+    :param batch:
+    :return:
+    """
+    if len(batch) == 1:
+        return False
+    return results is None or bool(graphql_payload.get("errors"))
+
+
+async def iter_users_batched_graphql_results(
+    data_region: DATA_REGION,
+    usernames: List[str],
+    get_request: Callable[[DATA_REGION, Sequence[str]], Dict],
+    parse: Callable[[Dict, Sequence[str]], Optional[Dict]],
+    concurrent_num: int = 5,
+    batch_size: Optional[int] = None,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Request many users by batched GraphQL requests, yield every user as soon as its batch is done.
+    A batch failed on payload level is split in halves and requested again, until a single user fails.
+    Transport failures and throttling are retried under the host rate limiter, but never split,
+    splitting would only double the number of requests while the host is rate limiting.
+    :param data_region:
+    :param usernames:
+    :param get_request: builds one aliased request of a batch
+    :param parse: maps the payload of a batch back to users, None if the whole batch failed
+    :param concurrent_num:
+    :param batch_size: default is `user_batch_size` in http config
+    :return: username and its parsed result, None if HTTP request failed
+    """
+    if batch_size is None:
+        batch_size = get_http_config().get("user_batch_size", 30)
+    batches = split_into_batches(list(dict.fromkeys(usernames)), batch_size)
+    while batches:
+        failed_batches = list()
+        async for batch, graphql_payload in multi_http_request_stream(
+            {batch: get_request(data_region, batch) for batch in batches},
+            concurrent_num=concurrent_num,
+        ):
+            # None payload means it reached max retry_num on transport level, never split it
+            results = None if graphql_payload is None else parse(graphql_payload, batch)
+            if graphql_payload is not None and is_batch_payload_failed(
+                graphql_payload, results, batch
+            ):
+                logger.warning(f"batch failed, split it. {data_region=} {len(batch)=}")
+                failed_batches.append(batch)
+                continue
+            for username in batch:
+                yield username, None if results is None else results[username]
+        batches = list()
+        for batch in failed_batches:
+            batches += split_into_batches(batch, (len(batch) + 1) // 2)
+
+
+def iter_users_rating_and_attended_contests_count(
+    data_region: DATA_REGION,
+    usernames: List[str],
+    concurrent_num: int = 5,
+    batch_size: Optional[int] = None,
+) -> AsyncIterator[Tuple[str, Optional[Tuple[float | None, int | None]]]]:
+    """
+    Request many users' rating and attended contests count by batched GraphQL requests
+    :param data_region:
+    :param usernames:
+    :param concurrent_num:
+    :param batch_size: default is `user_batch_size` in http config
+    :return: username and (rating, attended contests count), None if HTTP request failed
+    """
+    return iter_users_batched_graphql_results(
+        data_region,
+        usernames,
+        get_users_rating_request,
+        parse_users_rating,
+        concurrent_num,
+        batch_size,
+    )
+
+
+def iter_users_contest_history(
+    data_region: DATA_REGION,
+    usernames: List[str],
+    concurrent_num: int = 5,
+    batch_size: Optional[int] = None,
+) -> AsyncIterator[Tuple[str, Optional[List[Dict]]]]:
+    """
+    Request many users' contest history by batched GraphQL requests
+    :param data_region:
+    :param usernames:
+    :param concurrent_num:
+    :param batch_size: default is `user_batch_size` in http config
+    :return: username and its attended contests, None if HTTP request failed
+    """
+    return iter_users_batched_graphql_results(
+        data_region,
+        usernames,
+        get_users_contest_history_request,
+        parse_users_contest_history,
+        concurrent_num,
+        batch_size,
+    )
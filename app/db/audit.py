@@ -0,0 +1,139 @@
+from typing import Dict, Final, List, NamedTuple, Optional
+
+from loguru import logger
+
+from app.db.models import (
+    ContestRecordArchive,
+    ContestRecordPredict,
+    Question,
+    Submission,
+    User,
+)
+from app.db.mongodb import get_async_mongodb_collection
+
+# `SORT` means a blocking in-memory sort, which is as bad as a collection scan for large contests
+BAD_PLAN_STAGES: Final[List[str]] = ["COLLSCAN", "SORT"]
+
+
+class QueryShape(NamedTuple):
+    name: str
+    col_name: str
+    filter: Dict
+    sort: Optional[List] = None
+
+
+def get_hot_query_shapes(
+    contest_name: str = "weekly-contest-400",
+    username: str = "username",
+    data_region: str = "US",
+) -> List[QueryShape]:
+    """
+    Query shapes of hot paths in this project, only field names and operators matter for query plans.
+    Keep them in sync with the queries in `app` and `api` packages.
+    :param contest_name:
+    :param username:
+    :param data_region:
+    :return:
+    """
+    user_in_contest = {
+        "contest_name": contest_name,
+        "username": username,
+        "data_region": data_region,
+    }
+    participated = {"contest_name": contest_name, "score": {"$ne": 0}}
+    shapes = list()
+    for model in [ContestRecordPredict, ContestRecordArchive]:
+        shapes += [
+            QueryShape(f"{model.__name__} user", model.__name__, user_in_contest),
+            QueryShape(
+                f"{model.__name__} ranking page",
+                model.__name__,
+                participated,
+                [("rank", 1)],
+            ),
+            QueryShape(
+                f"{model.__name__} username in contest",
+                model.__name__,
+                {
+                    "contest_name": contest_name,
+                    "username": {"$in": [username, username.lower()]},
+                    "score": {"$ne": 0},
+                },
+            ),
+        ]
+    shapes += [
+        QueryShape(
+            "Submission upsert",
+            Submission.__name__,
+            user_in_contest | {"question_id": 1},
+        ),
+        QueryShape(
+            "Submission of contest", Submission.__name__, {"contest_name": contest_name}
+        ),
+        QueryShape(
+            "Question of contest",
+            Question.__name__,
+            {"contest_name": contest_name, "question_id": 1},
+        ),
+        QueryShape(
+            "User ratings",
+            User.__name__,
+            {"data_region": data_region, "username": {"$in": [username]}},
+        ),
+        QueryShape(
+            "User contest history",
+            User.__name__,
+            {
+                "data_region": data_region,
+                "username": {"$in": [username]},
+                "contest_history.contest_title": "Weekly Contest 400",
+            },
+        ),
+        QueryShape(
+            "User upsert",
+            User.__name__,
+            {"username": username, "data_region": data_region},
+        ),
+    ]
+    return shapes
+
+
+def get_plan_stages(plan: Dict) -> List[str]:
+    """
+    Flatten stage names of a winning plan tree.
+    :param plan:
+    :return:
+    """
+    stages = [plan["stage"]] if "stage" in plan else list()
+    if "inputStage" in plan:
+        stages += get_plan_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", list()):
+        stages += get_plan_stages(input_stage)
+    return stages
+
+
+async def audit_query_plans(
+    shapes: Optional[List[QueryShape]] = None,
+) -> List[Dict]:
+    """
+    Run `explain()` on every query shape, flag collection scans and in-memory sorts.
+    :param shapes: default is `get_hot_query_shapes()`
+    :return: audit result of every query shape
+    """
+    if shapes is None:
+        shapes = get_hot_query_shapes()
+    results = list()
+    for shape in shapes:
+        col = get_async_mongodb_collection(shape.col_name)
+        explain = await col.find(shape.filter, sort=shape.sort).explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        # slot-based execution engine nests the classic plan tree under `queryPlan`
+        stages = get_plan_stages(winning_plan.get("queryPlan", winning_plan))
+        bad_stages = [stage for stage in stages if stage in BAD_PLAN_STAGES]
+        result = {"name": shape.name, "stages": stages, "bad_stages": bad_stages}
+        if bad_stages:
+            logger.error(f"unindexed query plan {result=}")
+        else:
+            logger.info(f"{result=}")
+        results.append(result)
+    return results
@@ -0,0 +1,93 @@
+from typing import Any, Final, List, Literal, Sequence
+
+import numpy as np
+
+# `list`: plain BSON array, `packed`: fixed width little-endian uint16/uint32, `varint`: delta + zigzag varint
+REAL_TIME_RANK_ENCODING = Literal["list", "packed", "varint"]
+
+# the first byte of an encoded real_time_rank tells how the rest is encoded
+UINT16_TAG: Final[int] = 1
+UINT32_TAG: Final[int] = 2
+VARINT_TAG: Final[int] = 3
+
+
+def pack_real_time_rank(
+    ranks: Sequence[int],
+    varint: bool = False,
+) -> bytes:
+    """
+    Encode a real_time_rank list into compact bytes.
+    Fixed width uses uint16 whenever all ranks fit in it, otherwise uint32.
+    Varint stores zigzag encoded differences of adjacent ranks, which are small because ranks change gradually.
+    :param ranks:
+    :param varint:
+    :return:
+    """
+    if varint:
+        buffer = bytearray([VARINT_TAG])
+        last_rank = 0
+        for rank in ranks:
+            delta = int(rank) - last_rank
+            last_rank = int(rank)
+            value = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+            while value >= 0x80:
+                buffer.append((value & 0x7F) | 0x80)
+                value >>= 7
+            buffer.append(value)
+        return bytes(buffer)
+    array = np.asarray(ranks, dtype=np.int64)
+    if len(array) == 0 or array.max() <= np.iinfo(np.uint16).max:
+        return bytes([UINT16_TAG]) + array.astype("<u2").tobytes()
+    return bytes([UINT32_TAG]) + array.astype("<u4").tobytes()
+
+
+def unpack_real_time_rank(data: bytes) -> List[int]:
+    """
+    Decode bytes encoded by `pack_real_time_rank` back into a real_time_rank list.
+    :param data:
+    :return:
+    """
+    tag, payload = data[0], data[1:]
+    if tag == UINT16_TAG:
+        return np.frombuffer(payload, dtype="<u2").tolist()
+    if tag == UINT32_TAG:
+        return np.frombuffer(payload, dtype="<u4").tolist()
+    if tag == VARINT_TAG:
+        ranks = list()
+        last_rank = value = shift = 0
+        for byte in payload:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte & 0x80:
+                continue
+            last_rank += (value >> 1) if not value & 1 else -((value + 1) >> 1)
+            ranks.append(last_rank)
+            value = shift = 0
+        return ranks
+    raise ValueError(f"unknown real_time_rank encoding {tag=}")
+
+
+def encode_real_time_rank(
+    ranks: Sequence[int],
+    encoding: REAL_TIME_RANK_ENCODING,
+) -> List[int] | bytes:
+    """
+    Encode a real_time_rank list for storage
+    :param ranks:
+    :param encoding:
+    :return:
+    """
+    if encoding == "list":
+        return list(ranks)
+    return pack_real_time_rank(ranks, varint=encoding == "varint")
+
+
+def decode_real_time_rank(value: Any) -> Any:
+    """
+    Decode a stored real_time_rank transparently, lists and None are returned as is.
+    :param value:
+    :return:
+    """
+    if isinstance(value, bytes):
+        return unpack_real_time_rank(value)
+    return value
@@ -2,9 +2,10 @@ from datetime import datetime
 from typing import Counter, List, Literal, Optional, Tuple
 
 from beanie import Document
-from pydantic import Field
-from pymongo import IndexModel
+from pydantic import Field, field_validator
+from pymongo import ASCENDING, IndexModel
 
+from app.db.codec import decode_real_time_rank
 from app.db.components import PredictionEvent, UserContestHistoryRecord
 
 DATA_REGION = Literal["CN", "US"]
@@ -57,6 +58,15 @@ class ContestRecord(Document):
             "user_slug",
             "rank",
             "data_region",
+            # hot queries look up users within a contest, or page through a contest by rank
+            IndexModel(
+                [
+                    ("contest_name", ASCENDING),
+                    ("username", ASCENDING),
+                    ("data_region", ASCENDING),
+                ]
+            ),
+            IndexModel([("contest_name", ASCENDING), ("rank", ASCENDING)]),
         ]
 
 
@@ -67,12 +77,24 @@ class ContestRecordPredict(ContestRecord):
     predict_time: Optional[datetime] = None
 
 
+class ContestRecordProvisional(ContestRecord):
+    # Provisional records are recomputed repeatedly during the contest by live prediction,
+    # kept apart from ContestRecordPredict so that the final prediction is never mixed with them.
+    predict_time: Optional[datetime] = None
+
+
 class ContestRecordArchive(ContestRecord):
     # Archived records will be updated.
     # LeetCode would rejudge some submissions(cheat detection, adding test cases, etc.)
     update_time: datetime = Field(default_factory=datetime.utcnow)
+    # stored either as a plain list or as compact bytes, see `app.db.codec`, always a list once loaded.
     real_time_rank: Optional[list] = None
 
+    @field_validator("real_time_rank", mode="before")
+    @classmethod
+    def decode_real_time_rank(cls, value):
+        return decode_real_time_rank(value)
+
 
 class Question(Document):
     question_id: int
@@ -102,6 +124,7 @@ class Question(Document):
             "question_id",
             "title_slug",
             "contest_name",
+            IndexModel([("contest_name", ASCENDING), ("question_id", ASCENDING)]),
         ]
 
 
@@ -128,6 +151,14 @@ class Submission(Document):
             "data_region",
             "question_id",
             "date",
+            IndexModel(
+                [
+                    ("contest_name", ASCENDING),
+                    ("username", ASCENDING),
+                    ("data_region", ASCENDING),
+                    ("question_id", ASCENDING),
+                ]
+            ),
         ]
 
 
@@ -147,4 +178,5 @@ class User(Document):
             "user_slug",
             "data_region",
             "rating",
+            IndexModel([("username", ASCENDING), ("data_region", ASCENDING)]),
         ]
@@ -1,6 +1,7 @@
 import sys
+import time
 import urllib.parse
-from typing import Optional
+from typing import Any, Optional, Sequence
 
 # just for temporary autocompleting, given that motor doesn't have type annotations yet,
 # see https://jira.mongodb.org/browse/MOTOR-331
@@ -13,12 +14,14 @@ from motor.core import (  # bad idea to use these three here,
     AgnosticDatabase,
 )
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
 
 from app.config import get_yaml_config
 from app.db.models import (
     Contest,
     ContestRecordArchive,
     ContestRecordPredict,
+    ContestRecordProvisional,
     Question,
     Submission,
     User,
@@ -77,6 +80,46 @@ def get_async_mongodb_collection(col_name: str) -> AgnosticCollection:
     return db[col_name]
 
 
+async def bulk_write_in_batches(
+    col_name: str,
+    operations: Sequence[Any],
+    batch_size: Optional[int] = None,
+) -> int:
+    """
+    Send pymongo write operations (UpdateOne, InsertOne, etc.) as unordered bulk writes batch by batch,
+    so that tens of thousands of writes only cost a few round trips.
+    Log timing and error count for every batch.
+    :param col_name:
+    :param operations:
+    :param batch_size: default is `bulk_write_batch_size` in mongodb config
+    :return: total number of failed operations
+    """
+    if batch_size is None:
+        batch_size = get_mongodb_config().get("bulk_write_batch_size", 1000)
+    col = get_async_mongodb_collection(col_name)
+    batch_num = (len(operations) + batch_size - 1) // batch_size
+    total_error_num = 0
+    for i in range(0, len(operations), batch_size):
+        j = i + batch_size
+        batch = operations[i:j]
+        t1 = time.time()
+        try:
+            await col.bulk_write(batch, ordered=False)
+            error_num = 0
+        except BulkWriteError as e:
+            error_num = len(e.details.get("writeErrors", []))
+            logger.error(
+                f"{col_name=} bulk write errors, first one={e.details.get('writeErrors', [None])[0]}"
+            )
+        t2 = time.time()
+        total_error_num += error_num
+        logger.info(
+            f"{col_name=} batch {i // batch_size + 1}/{batch_num} "
+            f"size={len(batch)} cost {(t2 - t1) * 1e3:.2f} ms {error_num=}"
+        )
+    return total_error_num
+
+
 async def start_async_mongodb() -> None:
     """
     Start beanie when process started.
@@ -89,6 +132,7 @@ async def start_async_mongodb() -> None:
             document_models=[
                 Contest,
                 ContestRecordPredict,
+                ContestRecordProvisional,
                 ContestRecordArchive,
                 User,
                 Submission,
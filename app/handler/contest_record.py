@@ -1,42 +1,122 @@
 from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Type
 
-from beanie.odm.operators.update.general import Set
 from loguru import logger
+from pymongo import InsertOne, UpdateOne
 
+from app.constants import (
+    DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT,
+    DEFAULT_NEW_USER_RATING,
+)
+from app.core.predictor import (
+    LivePredictionState,
+    live_prediction_states,
+    solve_live_records,
+)
 from app.crawler.contest_record_and_submission import request_contest_records
-from app.db.models import DATA_REGION, ContestRecordArchive, ContestRecordPredict, User
+from app.db.models import (
+    DATA_REGION,
+    ContestRecord,
+    ContestRecordArchive,
+    ContestRecordPredict,
+    ContestRecordProvisional,
+)
+from app.db.mongodb import bulk_write_in_batches, get_async_mongodb_collection
 from app.handler.submission import save_submission
-from app.handler.user import save_users_of_contest
-from app.utils import exception_logger_reraise, gather_with_limited_concurrency
+from app.handler.user import (
+    find_users_rating_and_attended_contests_count,
+    get_users_rating_and_attended_contests_count,
+    save_users_of_contest,
+)
+from app.utils import exception_logger_reraise, exception_logger_silence, to_naive_utc
 
 
-@exception_logger_reraise
-async def save_predict_contest_records(
+@lru_cache
+def get_model_default_fields(model: Type[ContestRecord]) -> Tuple[str, ...]:
+    """
+    Fields which don't come from ranking pages but have defaults in `model`, such as `insert_time`
+    :param model:
+    :return:
+    """
+    return tuple(
+        field
+        for field in model.model_fields
+        if field not in ContestRecord.model_fields and field != "revision_id"
+    )
+
+
+def parse_contest_record(
     contest_name: str,
-    data_region: DATA_REGION,
-) -> None:
+    contest_record_dict: Dict,
+    model: Type[ContestRecord],
+) -> Dict:
     """
-    Save fetched contest records into `ContestRecordPredict` collection for predicting new contest
+    Cheap replacement of `model.model_validate` for bulk ingestion, build an insert-ready dict directly.
+    Only rows with exactly the expected types take the fast path, others fall back to pydantic validation.
     :param contest_name:
-    :param data_region:
+    :param contest_record_dict:
+    :param model:
     :return:
     """
-
-    async def _fill_old_rating_and_count(_contest_record: ContestRecordPredict):
-        user = await User.find_one(
-            User.username == _contest_record.username,
-            User.data_region == _contest_record.data_region,
+    try:
+        contest_record = {
+            "contest_name": contest_name,
+            "contest_id": contest_record_dict["contest_id"],
+            "username": contest_record_dict["username"],
+            "user_slug": contest_record_dict["user_slug"],
+            "data_region": contest_record_dict["data_region"],
+            "country_code": contest_record_dict.get("country_code"),
+            "country_name": contest_record_dict.get("country_name"),
+            "rank": contest_record_dict["rank"],
+            "score": contest_record_dict["score"],
+            "finish_time": datetime.utcfromtimestamp(
+                contest_record_dict["finish_time"]
+            ),
+            "attendedContestsCount": None,
+            "old_rating": None,
+            "new_rating": None,
+            "delta_rating": None,
+        }
+        if not (
+            type(contest_record["contest_id"]) is int
+            and type(contest_record["rank"]) is int
+            and type(contest_record["score"]) is int
+            and type(contest_record["username"]) is str
+            and type(contest_record["user_slug"]) is str
+            and contest_record["data_region"] in ("CN", "US")
+            and isinstance(contest_record["country_code"], (str, type(None)))
+            and isinstance(contest_record["country_name"], (str, type(None)))
+        ):
+            raise TypeError("unexpected field type")
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        contest_record = model.model_validate(
+            contest_record_dict | {"contest_name": contest_name}
+        ).model_dump(exclude={"id", "revision_id"})
+        contest_record["finish_time"] = to_naive_utc(contest_record["finish_time"])
+        return contest_record
+    for field in get_model_default_fields(model):
+        contest_record[field] = model.model_fields[field].get_default(
+            call_default_factory=True
         )
-        _contest_record.old_rating = user.rating
-        _contest_record.attendedContestsCount = user.attendedContestsCount
-        await _contest_record.save()
+    return contest_record
 
-    contest_record_list, _ = await request_contest_records(contest_name, data_region)
+
+def parse_unique_contest_records(
+    contest_name: str,
+    data_region: DATA_REGION,
+    contest_record_list: List[Dict],
+    model: Type[ContestRecord],
+) -> List[Dict]:
+    """
+    Parse fetched contest records by `parse_contest_record`, only the first record of each user is kept
+    :param contest_name:
+    :param data_region:
+    :param contest_record_list:
+    :param model:
+    :return:
+    """
     contest_records = list()
-    # Full update, delete all old records
-    await ContestRecordPredict.find(
-        ContestRecordPredict.contest_name == contest_name,
-    ).delete()
     unique_keys = set()
     for contest_record_dict in contest_record_list:
         # Only the API for the US site has changed. Now, `username` from LCCN is `user_slug` from LCUS.
@@ -49,22 +129,53 @@ async def save_predict_contest_records(
             logger.warning(f"duplicated user record. {contest_record_dict=}")
             continue
         unique_keys.add(key)
-        contest_record_dict.update({"contest_name": contest_name})
-        contest_record = ContestRecordPredict.model_validate(contest_record_dict)
-        contest_records.append(contest_record)
-    insert_tasks = [
-        ContestRecordPredict.insert_one(contest_record)
-        for contest_record in contest_records
-    ]
-    await gather_with_limited_concurrency(insert_tasks, max_con_num=50)
+        contest_records.append(
+            parse_contest_record(contest_name, contest_record_dict, model)
+        )
+    return contest_records
+
+
+@exception_logger_reraise
+async def save_predict_contest_records(
+    contest_name: str,
+    data_region: DATA_REGION,
+) -> None:
+    """
+    Save fetched contest records into `ContestRecordPredict` collection for predicting new contest
+    :param contest_name:
+    :param data_region:
+    :return:
+    """
+    contest_record_list, _ = await request_contest_records(contest_name, data_region)
+    contest_records = parse_unique_contest_records(
+        contest_name, data_region, contest_record_list, ContestRecordPredict
+    )
+    # Full update, delete all old records
+    await ContestRecordPredict.find(
+        ContestRecordPredict.contest_name == contest_name,
+    ).delete()
+    await bulk_write_in_batches(
+        ContestRecordPredict.__name__,
+        [InsertOne(contest_record) for contest_record in contest_records],
+    )
     await save_users_of_contest(contest_name=contest_name, predict=True)
     # fill rating and attended count, must be called after save_users_of_contest and before predict_contest,
-    fill_tasks = [
-        _fill_old_rating_and_count(contest_record)
-        for contest_record in contest_records
-        if contest_record.score != 0
+    # read all users at once into memory, then write them back by bulk updates.
+    user_ratings = await get_users_rating_and_attended_contests_count(
+        [
+            (contest_record["username"], contest_record["data_region"])
+            for contest_record in contest_records
+            if contest_record["score"] != 0
+        ]
+    )
+    fill_operations = [
+        UpdateOne(
+            {"contest_name": contest_name, "username": username, "data_region": region},
+            {"$set": {"old_rating": rating, "attendedContestsCount": count}},
+        )
+        for (username, region), (rating, count) in user_ratings.items()
     ]
-    await gather_with_limited_concurrency(fill_tasks, max_con_num=50)
+    await bulk_write_in_batches(ContestRecordPredict.__name__, fill_operations)
 
 
 @exception_logger_reraise
@@ -75,50 +186,224 @@ async def save_archive_contest_records(
 ) -> None:
     """
     Save fetched contest records into `ContestRecordArchive` collection for archiving old contests
+    Only new rows and rows changed by rejudging (rank, score or finish_time) are written, by unordered bulk upserts.
     :param contest_name:
     :param data_region:
     :param save_users:
     :return:
     """
-    time_point = datetime.utcnow()
     (contest_record_list, nested_submission_list) = await request_contest_records(
-        contest_name, data_region
+        contest_name, data_region, use_cache=True
     )
-    contest_records = list()
+    col = get_async_mongodb_collection(ContestRecordArchive.__name__)
+    # compact index of existing rows, only fields which could be changed by rejudging are loaded
+    existing_records = {
+        (doc["username"], doc["data_region"]): doc
+        async for doc in col.find(
+            {"contest_name": contest_name},
+            {"username": 1, "data_region": 1, "rank": 1, "score": 1, "finish_time": 1},
+            batch_size=10000,
+        )
+    }
+    operations = list()
+    fetched_keys = set()
     for contest_record_dict in contest_record_list:
         # Only the API for the US site has changed. Now, `username` from LCCN is `user_slug` from LCUS.
         if data_region == "US":
             # TODO: LCUS changed API, now we have to use `user_slug`, not `username`
             contest_record_dict["username"] = contest_record_dict["user_slug"]
-        contest_record_dict.update({"contest_name": contest_name})
-        contest_record = ContestRecordArchive.model_validate(contest_record_dict)
-        contest_records.append(contest_record)
-    tasks = [
-        ContestRecordArchive.find_one(
-            ContestRecordArchive.contest_name == contest_record.contest_name,
-            ContestRecordArchive.username == contest_record.username,
-            ContestRecordArchive.data_region == contest_record.data_region,
-        ).upsert(
-            Set(
-                {
-                    ContestRecordArchive.rank: contest_record.rank,
-                    ContestRecordArchive.score: contest_record.score,
-                    ContestRecordArchive.finish_time: contest_record.finish_time,
-                    ContestRecordArchive.update_time: contest_record.update_time,
-                }
-            ),
-            on_insert=contest_record,
+        contest_record = parse_contest_record(
+            contest_name, contest_record_dict, ContestRecordArchive
         )
-        for contest_record in contest_records
+        key = (contest_record["username"], contest_record["data_region"])
+        fetched_keys.add(key)
+        updated_fields = {
+            field: contest_record[field] for field in ["rank", "score", "finish_time"]
+        }
+        if (existing := existing_records.get(key)) is None:
+            operations.append(
+                UpdateOne(
+                    {
+                        "contest_name": contest_name,
+                        "username": contest_record["username"],
+                        "data_region": contest_record["data_region"],
+                    },
+                    {
+                        "$set": updated_fields,
+                        "$setOnInsert": {
+                            k: v
+                            for k, v in contest_record.items()
+                            if k not in updated_fields
+                        },
+                    },
+                    upsert=True,
+                )
+            )
+        elif any(existing.get(k) != v for k, v in updated_fields.items()):
+            operations.append(
+                UpdateOne(
+                    {"_id": existing["_id"]},
+                    {"$set": {**updated_fields, "update_time": datetime.utcnow()}},
+                )
+            )
+    logger.info(
+        f"{contest_name=} {len(existing_records)=} {len(fetched_keys)=} changed_num={len(operations)}"
+    )
+    await bulk_write_in_batches(ContestRecordArchive.__name__, operations)
+    # remove old records which are not in the ranking list anymore
+    stale_ids = [
+        doc["_id"] for key, doc in existing_records.items() if key not in fetched_keys
     ]
-    await gather_with_limited_concurrency(tasks, max_con_num=50)
-    # remove old records
-    await ContestRecordArchive.find(
-        ContestRecordArchive.contest_name == contest_name,
-        ContestRecordArchive.update_time < time_point,
-    ).delete()
+    if stale_ids:
+        result = await col.delete_many({"_id": {"$in": stale_ids}})
+        logger.info(f"removed stale records {result.deleted_count=}")
     if save_users is True:
         await save_users_of_contest(contest_name=contest_name, predict=False)
     else:
         logger.info(f"{save_users=}, will not save users")
     await save_submission(contest_name, contest_record_list, nested_submission_list)
+
+
+async def fill_provisional_contest_records(
+    contest_records: List[Dict],
+    state: Optional[LivePredictionState],
+) -> Tuple[Dict[Tuple[str, str], Tuple[float, int]], bool]:
+    """
+    Fill `old_rating` and `attendedContestsCount` of provisional records.
+    Only ratings found in User collection are cached in state, users not found get default values for now,
+    they are queried again on every run because `save_predict_contest_records` may have saved them since.
+    :param contest_records:
+    :param state: state of the last run, None if there isn't
+    :return: cached ratings, and whether any default rating used by the last run has changed
+    """
+    user_ratings = dict(state.user_ratings) if state else dict()
+    missing_keys = [
+        (record["username"], record["data_region"])
+        for record in contest_records
+        if (record["username"], record["data_region"]) not in user_ratings
+    ]
+    found_ratings = await find_users_rating_and_attended_contests_count(missing_keys)
+    user_ratings |= found_ratings
+    default_rating = (DEFAULT_NEW_USER_RATING, DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT)
+    for record in contest_records:
+        record["old_rating"], record["attendedContestsCount"] = user_ratings.get(
+            (record["username"], record["data_region"]), default_rating
+        )
+    default_rating_changed = state is not None and any(
+        key in state.saved_keys and rating != default_rating
+        for key, rating in found_ratings.items()
+    )
+    return user_ratings, default_rating_changed
+
+
+async def upsert_provisional_contest_records(
+    contest_name: str,
+    solved_records: List[Dict],
+    stale_keys: set[Tuple[str, str]],
+) -> None:
+    """
+    Upsert re-solved records into `ContestRecordProvisional`, then remove users who disappeared from ranking.
+    :param contest_name:
+    :param solved_records:
+    :param stale_keys:
+    :return:
+    """
+    predict_time = datetime.utcnow()
+    operations = list()
+    for contest_record in solved_records:
+        updated_fields = {
+            field: contest_record[field]
+            for field in [
+                "rank",
+                "score",
+                "finish_time",
+                "old_rating",
+                "attendedContestsCount",
+                "delta_rating",
+                "new_rating",
+            ]
+        } | {"predict_time": predict_time}
+        operations.append(
+            UpdateOne(
+                {
+                    "contest_name": contest_name,
+                    "username": contest_record["username"],
+                    "data_region": contest_record["data_region"],
+                },
+                {
+                    "$set": updated_fields,
+                    "$setOnInsert": {
+                        k: v
+                        for k, v in contest_record.items()
+                        if k not in updated_fields
+                    },
+                },
+                upsert=True,
+            )
+        )
+    await bulk_write_in_batches(ContestRecordProvisional.__name__, operations)
+    if stale_keys:
+        result = await get_async_mongodb_collection(
+            ContestRecordProvisional.__name__
+        ).delete_many(
+            {
+                "contest_name": contest_name,
+                "$or": [
+                    {"username": username, "data_region": data_region}
+                    for username, data_region in stale_keys
+                ],
+            }
+        )
+        logger.info(f"removed stale provisional records {result.deleted_count=}")
+
+
+@exception_logger_silence
+async def save_provisional_contest_records(
+    contest_name: str,
+) -> None:
+    """
+    Provisional prediction during the contest, results are saved in `ContestRecordProvisional` collection.
+    State of the last run is kept in `live_prediction_states`, so that only users whose rank moved are re-solved.
+    :param contest_name:
+    :return:
+    """
+    contest_record_list, _ = await request_contest_records(contest_name, "CN")
+    contest_records = [
+        contest_record
+        for contest_record in parse_unique_contest_records(
+            contest_name, "CN", contest_record_list, ContestRecordProvisional
+        )
+        if contest_record["score"] != 0
+    ]
+    if not contest_records:
+        logger.info(f"no records with nonzero score yet for {contest_name=}")
+        return
+    state = live_prediction_states.get(contest_name)
+    user_ratings, default_rating_changed = await fill_provisional_contest_records(
+        contest_records, state
+    )
+    histogram, convolution, solved, solved_records = solve_live_records(
+        contest_name, contest_records, None if default_rating_changed else state
+    )
+    saved_keys = {
+        (record["username"], record["data_region"]) for record in contest_records
+    }
+    if state is None:
+        # no state in this process, whatever saved before is unreliable
+        await ContestRecordProvisional.find(
+            ContestRecordProvisional.contest_name == contest_name,
+        ).delete()
+        stale_keys = set()
+    else:
+        # rarely happens, user disappeared from ranking
+        stale_keys = state.saved_keys - saved_keys
+    for key in stale_keys:
+        solved.pop(key, None)
+    await upsert_provisional_contest_records(contest_name, solved_records, stale_keys)
+    live_prediction_states[contest_name] = LivePredictionState(
+        histogram=histogram,
+        convolution=convolution,
+        user_ratings=user_ratings,
+        solved=solved,
+        saved_keys=saved_keys,
+    )
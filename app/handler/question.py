@@ -2,31 +2,33 @@ import asyncio
 from datetime import datetime, timedelta
 from typing import List
 
+import numpy as np
 from beanie.odm.operators.update.general import Set
 from loguru import logger
+from pymongo import UpdateOne
 
 from app.crawler.question import request_question_list
 from app.db.models import Question, Submission
-from app.utils import gather_with_limited_concurrency, get_contest_start_time
+from app.db.mongodb import bulk_write_in_batches, get_async_mongodb_collection
+from app.utils import get_contest_start_time
 
 
-async def real_time_count_at_time_point(
+def get_real_time_points(
     contest_name: str,
-    question_id: int,
-    time_point: datetime,
-) -> int:
+    delta_minutes: int = 1,
+) -> np.ndarray:
     """
-    For a single question, count its finished submission at a given time point.
+    Time points of real time statistics, every delta_minutes after contest start until the end of contest.
     :param contest_name:
-    :param question_id:
-    :param time_point:
-    :return:
+    :param delta_minutes:
+    :return: datetime64[ms] array
     """
-    return await Submission.find(
-        Submission.contest_name == contest_name,
-        Submission.question_id == question_id,
-        Submission.date <= time_point,
-    ).count()
+    start_time = get_contest_start_time(contest_name)
+    return np.arange(
+        np.datetime64(start_time + timedelta(minutes=delta_minutes), "ms"),
+        np.datetime64(start_time + timedelta(minutes=90), "ms") + 1,
+        np.timedelta64(delta_minutes, "m"),
+    )
 
 
 async def save_questions_real_time_count(
@@ -35,28 +37,41 @@ async def save_questions_real_time_count(
 ) -> None:
     """
     For every delta_minutes, count accepted submissions for each question.
+    All (question_id, date) pairs are fetched at once, then a per time point histogram is accumulated.
     :param contest_name:
     :param delta_minutes:
     :return:
     """
-    time_series = list()
-    start_time = get_contest_start_time(contest_name)
-    end_time = start_time + timedelta(minutes=90)
-    while (start_time := start_time + timedelta(minutes=delta_minutes)) <= end_time:
-        time_series.append(start_time)
-    logger.info(f"{contest_name=} {time_series=}")
-    questions = await Question.find(
-        Question.contest_name == contest_name,
-    ).to_list()
-    for question in questions:
-        tasks = [
-            real_time_count_at_time_point(
-                contest_name, question.question_id, time_point
+    time_points = get_real_time_points(contest_name, delta_minutes)
+    logger.info(f"{contest_name=} {time_points=}")
+    question_ids, dates = list(), list()
+    async for doc in get_async_mongodb_collection(Submission.__name__).find(
+        {"contest_name": contest_name},
+        {"_id": 0, "question_id": 1, "date": 1},
+        batch_size=10000,
+    ):
+        question_ids.append(doc["question_id"])
+        dates.append(doc["date"])
+    question_ids = np.array(question_ids, dtype=np.int64)
+    # first time point which counts each submission, `len(time_points)` means never
+    first_points = np.searchsorted(
+        time_points, np.array(dates, dtype="datetime64[ms]"), side="left"
+    )
+    operations = list()
+    async for doc in get_async_mongodb_collection(Question.__name__).find(
+        {"contest_name": contest_name}, {"question_id": 1}
+    ):
+        histogram = np.bincount(
+            first_points[question_ids == doc["question_id"]],
+            minlength=len(time_points) + 1,
+        )
+        real_time_count = np.cumsum(histogram[: len(time_points)]).tolist()
+        operations.append(
+            UpdateOne(
+                {"_id": doc["_id"]}, {"$set": {"real_time_count": real_time_count}}
             )
-            for time_point in time_series
-        ]
-        question.real_time_count = await gather_with_limited_concurrency(tasks)
-        await question.save()
+        )
+    await bulk_write_in_batches(Question.__name__, operations)
     logger.success("finished")
 
 
@@ -1,86 +1,101 @@
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+import time
+from datetime import datetime
+from typing import Dict, Final, List, Optional
 
-from beanie.odm.operators.update.general import Set
+import numpy as np
 from loguru import logger
+from pydantic import ValidationError
+from pymongo import UpdateOne
 
+from app.db.codec import (
+    REAL_TIME_RANK_ENCODING,
+    decode_real_time_rank,
+    encode_real_time_rank,
+)
 from app.db.models import ContestRecordArchive, Submission
-from app.db.mongodb import get_async_mongodb_collection
+from app.db.mongodb import (
+    bulk_write_in_batches,
+    get_async_mongodb_collection,
+    get_mongodb_config,
+)
 from app.db.views import UserKey
-from app.handler.question import save_questions, save_questions_real_time_count
-from app.utils import (
-    exception_logger_reraise,
-    gather_with_limited_concurrency,
-    get_contest_start_time,
+from app.handler.question import (
+    get_real_time_points,
+    save_questions,
+    save_questions_real_time_count,
 )
+from app.utils import exception_logger_reraise, to_naive_utc
 
+# fields which could be changed by rejudging, `lang` is included for old records which don't have it
+SUBMISSION_UPDATED_FIELDS: Final[List[str]] = ["date", "fail_count", "credit", "lang"]
 
-async def aggregate_rank_at_time_point(
-    contest_name: str,
-    time_point: datetime,
-) -> Tuple[Dict[Tuple[str, str], int], int]:
+
+def get_real_time_ranks(
+    user_indices: np.ndarray,
+    dates: np.ndarray,
+    credits: np.ndarray,
+    fail_counts: np.ndarray,
+    user_num: int,
+    time_points: np.ndarray,
+) -> np.ndarray:
     """
-    For a single time_point, rank all the participants.
-    Be careful that every wrong submission should add a 5-minutes penalty.
-    :param contest_name:
-    :param time_point:
-    :return:
+    Rank all the participants at every time_point in a single sweep.
+    At a time_point, only submissions with `date <= time_point` count, every user is ranked by
+    `credit_sum` descending then `penalty_date` ascending, where `penalty_date` is the latest submission date
+    plus a 5-minutes penalty for every wrong submission. Users with the same pair share the same rank,
+    users without any submission yet get `last_rank + 1`.
+    Cumulative state is carried column by column, only one column of it is kept in memory besides the ranks.
+    :param user_indices: user index of each submission, in [0, user_num)
+    :param dates: submission dates in milliseconds
+    :param credits:
+    :param fail_counts:
+    :param user_num:
+    :param time_points: ascending time_points in milliseconds
+    :return: ranks with shape (user_num, len(time_points))
     """
-    # hard to use beanie here, so use raw MongoDB aggregation
-    col = get_async_mongodb_collection(Submission.__name__)
-    rank_map = dict()
-    last_credit_sum = None
-    last_penalty_date = None
-    tie_rank = raw_rank = 0
-    pipeline = [
-        {"$match": {"contest_name": contest_name, "date": {"$lte": time_point}}},
-        {
-            "$group": {
-                "_id": {"username": "$username", "data_region": "$data_region"},
-                "credit_sum": {"$sum": "$credit"},
-                "fail_count_sum": {"$sum": "$fail_count"},
-                "date_max": {"$max": "$date"},
-            }
-        },
-        {
-            "$addFields": {
-                "penalty_date": {
-                    "$dateAdd": {
-                        "startDate": "$date_max",
-                        "unit": "minute",
-                        "amount": {"$multiply": [5, "$fail_count_sum"]},
-                    }
-                },
-                "username": "$_id.username",
-                "data_region": "$_id.data_region",
-            }
-        },
-        {"$unset": ["_id"]},
-        {"$sort": {"credit_sum": -1, "penalty_date": 1}},
-        {
-            "$project": {
-                "_id": 0,
-                "data_region": 1,
-                "username": 1,
-                "credit_sum": 1,
-                "fail_count_sum": 1,
-                "penalty_date": 1,
-            }
-        },
-    ]
-    async for doc in col.aggregate(pipeline):
-        raw_rank += 1
-        if (
-            doc["credit_sum"] == last_credit_sum
-            and doc["penalty_date"] == last_penalty_date
-        ):
-            rank_map[(doc["username"], doc["data_region"])] = tie_rank
-        else:
-            tie_rank = raw_rank
-            rank_map[(doc["username"], doc["data_region"])] = raw_rank
-        last_credit_sum = doc["credit_sum"]
-        last_penalty_date = doc["penalty_date"]
-    return rank_map, raw_rank
+    time_point_num = len(time_points)
+    # first time_point which includes each submission, `time_point_num` means never
+    first_points = np.searchsorted(time_points, dates, side="left")
+    included = first_points < time_point_num
+    # group submissions by their first time_point, so that each column only applies its own submissions
+    order = np.argsort(first_points[included], kind="stable")
+    user_indices, dates = user_indices[included][order], dates[included][order]
+    credits, fail_counts = credits[included][order], fail_counts[included][order]
+    bounds = np.searchsorted(
+        first_points[included][order], np.arange(time_point_num + 1), side="left"
+    )
+    # cumulative state of every user up to the current time_point, only one column is kept in memory
+    credit_sum = np.zeros(user_num, dtype=np.int64)
+    fail_count_sum = np.zeros(user_num, dtype=np.int64)
+    date_max = np.full(user_num, np.iinfo(np.int64).min, dtype=np.int64)
+    submitted = np.zeros(user_num, dtype=bool)
+    # ranks never exceed user_num + 1
+    ranks = np.empty((user_num, time_point_num), dtype=np.int32)
+    for i in range(time_point_num):
+        j, k = bounds[i], bounds[i + 1]
+        np.add.at(credit_sum, user_indices[j:k], credits[j:k])
+        np.add.at(fail_count_sum, user_indices[j:k], fail_counts[j:k])
+        np.maximum.at(date_max, user_indices[j:k], dates[j:k])
+        submitted[user_indices[j:k]] = True
+        users = np.flatnonzero(submitted)
+        user_credit_sum = credit_sum[users]
+        penalty_date = date_max[users] + fail_count_sum[users] * (5 * 60 * 1000)
+        rank_order = np.lexsort((penalty_date, -user_credit_sum))
+        user_credit_sum, penalty_date = (
+            user_credit_sum[rank_order],
+            penalty_date[rank_order],
+        )
+        # a new rank starts wherever (credit_sum, penalty_date) differs from the previous one
+        new_rank = np.ones(len(users), dtype=bool)
+        new_rank[1:] = (user_credit_sum[1:] != user_credit_sum[:-1]) | (
+            penalty_date[1:] != penalty_date[:-1]
+        )
+        raw_ranks = np.arange(1, len(users) + 1)
+        ranks[:, i] = len(users) + 1
+        ranks[users[rank_order], i] = np.maximum.accumulate(
+            np.where(new_rank, raw_ranks, 0)
+        )
+    return ranks
 
 
 async def save_real_time_rank(
@@ -88,8 +103,8 @@ async def save_real_time_rank(
     delta_minutes: int = 1,
 ) -> None:
     """
-    For every delta_minutes, invoke `aggregate_rank_at_time_point` function to get ranking on single time_point
-    Then append every user's ranking to a list and save it
+    For every delta_minutes, get ranking on single time_point by `get_real_time_ranks`
+    Submissions are fetched only once, then every user's ranking list is saved
     :param contest_name:
     :param delta_minutes:
     :return:
@@ -103,40 +118,169 @@ async def save_real_time_rank(
         .project(UserKey)
         .to_list()
     )
-    real_time_rank_map = {(user.username, user.data_region): list() for user in users}
-    start_time = get_contest_start_time(contest_name)
-    end_time = start_time + timedelta(minutes=90)
-    i = 1
-    while (start_time := start_time + timedelta(minutes=delta_minutes)) <= end_time:
-        rank_map, last_rank = await aggregate_rank_at_time_point(
-            contest_name, start_time
+    user_index_map = {
+        (user.username, user.data_region): i for i, user in enumerate(users)
+    }
+    user_indices, dates, credits, fail_counts = list(), list(), list(), list()
+    col = get_async_mongodb_collection(Submission.__name__)
+    async for doc in col.find(
+        {"contest_name": contest_name},
+        {
+            "_id": 0,
+            "username": 1,
+            "data_region": 1,
+            "date": 1,
+            "credit": 1,
+            "fail_count": 1,
+        },
+        batch_size=10000,
+    ):
+        # users who are not in the archived records still take part in the ranking
+        user_indices.append(
+            user_index_map.setdefault(
+                (doc["username"], doc["data_region"]), len(user_index_map)
+            )
         )
-        last_rank += 1
-        for (username, data_region), rank in rank_map.items():
-            real_time_rank_map[(username, data_region)].append(rank)
-        for k in real_time_rank_map.keys():
-            if len(real_time_rank_map[k]) != i:
-                real_time_rank_map[k].append(last_rank)
-        i += 1
-    tasks = [
-        ContestRecordArchive.find_one(
-            ContestRecordArchive.contest_name == contest_name,
-            ContestRecordArchive.username == username,
-            ContestRecordArchive.data_region == data_region,
-        ).update(
-            Set(
-                {
-                    ContestRecordArchive.real_time_rank: rank_list,
+        dates.append(doc["date"])
+        credits.append(doc["credit"])
+        fail_counts.append(doc["fail_count"])
+    time_points = get_real_time_points(contest_name, delta_minutes)
+    ranks = get_real_time_ranks(
+        np.array(user_indices, dtype=np.int64),
+        np.array(dates, dtype="datetime64[ms]").astype(np.int64),
+        np.array(credits, dtype=np.int64),
+        np.array(fail_counts, dtype=np.int64),
+        len(user_index_map),
+        time_points.astype(np.int64),
+    )
+    encoding = get_real_time_rank_encoding()
+    operations = [
+        UpdateOne(
+            {
+                "contest_name": contest_name,
+                "username": user.username,
+                "data_region": user.data_region,
+            },
+            {
+                "$set": {
+                    "real_time_rank": encode_real_time_rank(ranks[i].tolist(), encoding)
                 }
-            )
+            },
         )
-        for (username, data_region), rank_list in real_time_rank_map.items()
+        for i, user in enumerate(users)
     ]
-    logger.info("updating real_time_rank field in ContestRecordArchive collection")
-    await gather_with_limited_concurrency(tasks, max_con_num=5)
+    logger.info(
+        f"updating real_time_rank field in ContestRecordArchive collection {encoding=}"
+    )
+    await bulk_write_in_batches(ContestRecordArchive.__name__, operations)
     logger.success(f"finished updating real_time_rank for {contest_name=}")
 
 
+def get_real_time_rank_encoding() -> REAL_TIME_RANK_ENCODING:
+    """
+    Storage encoding of real_time_rank, plain list by default, see `app.db.codec`
+    :return:
+    """
+    return get_mongodb_config().get("real_time_rank_encoding", "list")
+
+
+async def migrate_real_time_rank(
+    contest_name: str,
+    encoding: REAL_TIME_RANK_ENCODING,
+) -> int:
+    """
+    Re-encode stored real_time_rank of a contest, both from and to any encoding.
+    :param contest_name:
+    :param encoding:
+    :return: number of migrated records
+    """
+    col = get_async_mongodb_collection(ContestRecordArchive.__name__)
+    operations = [
+        UpdateOne(
+            {"_id": doc["_id"]},
+            {
+                "$set": {
+                    "real_time_rank": encode_real_time_rank(
+                        decode_real_time_rank(doc["real_time_rank"]), encoding
+                    )
+                }
+            },
+        )
+        async for doc in col.find(
+            {"contest_name": contest_name, "real_time_rank": {"$ne": None}},
+            {"real_time_rank": 1},
+            batch_size=10000,
+        )
+    ]
+    error_num = await bulk_write_in_batches(ContestRecordArchive.__name__, operations)
+    logger.success(
+        f"migrated real_time_rank {contest_name=} {encoding=} {len(operations)=} {error_num=}"
+    )
+    return len(operations)
+
+
+def parse_submission(
+    contest_name: str,
+    username: str,
+    credit: int,
+    submission_dict: Dict,
+) -> Dict:
+    """
+    Cheap replacement of `Submission.model_validate` for bulk ingestion, only converts field types.
+    `date` from LeetCode is a unix timestamp, convert it to naive UTC datetime as MongoDB gives back.
+    :param contest_name:
+    :param username:
+    :param credit:
+    :param submission_dict:
+    :return:
+    """
+    return {
+        "contest_name": contest_name,
+        "username": username,
+        "data_region": submission_dict["data_region"],
+        "question_id": int(submission_dict["question_id"]),
+        "date": datetime.utcfromtimestamp(submission_dict["date"]),
+        "fail_count": int(submission_dict["fail_count"]),
+        "credit": credit,
+        "submission_id": int(submission_dict["submission_id"]),
+        "status": int(submission_dict["status"]),
+        "contest_id": int(submission_dict["contest_id"]),
+        # watch out: US data_region doesn't have `lang` field before weekly-contest-364
+        "lang": submission_dict.get("lang"),
+    }
+
+
+def validate_submission(
+    contest_name: str,
+    username: str,
+    credit: int,
+    submission_dict: Dict,
+) -> Optional[Dict]:
+    """
+    Try `parse_submission` first, fall back to `Submission.model_validate` for rows it cannot convert.
+    :param contest_name:
+    :param username:
+    :param credit:
+    :param submission_dict:
+    :return: None if pydantic cannot validate it either
+    """
+    try:
+        return parse_submission(contest_name, username, credit, submission_dict)
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        pass
+    try:
+        # `id` from LeetCode is not the document id
+        submission = Submission.model_validate(
+            {k: v for k, v in submission_dict.items() if k != "id"}
+            | {"contest_name": contest_name, "username": username, "credit": credit}
+        ).model_dump(exclude={"id", "revision_id", "update_time"})
+    except ValidationError as e:
+        logger.warning(f"invalid submission {e=} {username=} {submission_dict=}")
+        return None
+    submission["date"] = to_naive_utc(submission["date"])
+    return submission
+
+
 @exception_logger_reraise
 async def save_submission(
     contest_name: str,
@@ -145,60 +289,104 @@ async def save_submission(
 ) -> None:
     """
     Save all of submission-related data to MongoDB
+    Only new submissions and submissions changed by rejudging are written, by unordered bulk upserts.
     :param contest_name:
     :param contest_record_list:
     :param nested_submission_list:
     :return:
     """
-    time_point = datetime.utcnow()
+    t1 = time.time()
     questions = await save_questions(contest_name)
     question_credit_mapper = {
         question.question_id: question.credit for question in questions
     }
-    submissions = list()
+    submissions = dict()
+    unparsed_usernames = set()
     for contest_record_dict, nested_submission_dict in zip(
         contest_record_list, nested_submission_list
     ):
         for question_id, submission_dict in nested_submission_dict.items():
-            submission_dict.pop("id")
-            submission_dict |= {
-                "contest_name": contest_name,
-                "username": contest_record_dict["username"],
-                "credit": question_credit_mapper[int(question_id)],
-            }
-        submissions.extend(
-            [
-                Submission.model_validate(submission_dict)
-                for submission_dict in nested_submission_dict.values()
-            ]
-        )
-    tasks = [
-        Submission.find_one(
-            Submission.contest_name == submission.contest_name,
-            Submission.username == submission.username,
-            Submission.data_region == submission.data_region,
-            Submission.question_id == submission.question_id,
-        ).upsert(
-            Set(
-                {
-                    Submission.date: submission.date,
-                    Submission.fail_count: submission.fail_count,
-                    Submission.credit: submission.credit,
-                    Submission.update_time: submission.update_time,
-                    Submission.lang: submission.lang,
-                }
-            ),
-            on_insert=submission,
+            if (
+                submission := validate_submission(
+                    contest_name,
+                    contest_record_dict["username"],
+                    question_credit_mapper[int(question_id)],
+                    submission_dict,
+                )
+            ) is None:
+                # keep whatever saved before rather than deleting it as stale
+                unparsed_usernames.add(contest_record_dict["username"])
+                continue
+            key = (
+                submission["username"],
+                submission["data_region"],
+                submission["question_id"],
+            )
+            submissions[key] = submission
+    col = get_async_mongodb_collection(Submission.__name__)
+    existing_submissions = {
+        (doc["username"], doc["data_region"], doc["question_id"]): doc
+        async for doc in col.find(
+            {"contest_name": contest_name},
+            {
+                "username": 1,
+                "data_region": 1,
+                "question_id": 1,
+                **{field: 1 for field in SUBMISSION_UPDATED_FIELDS},
+            },
+            batch_size=10000,
         )
-        for submission in submissions
-    ]
-    logger.info("updating Submission collection")
-    await gather_with_limited_concurrency(tasks, max_con_num=5)
+    }
+    update_time = datetime.utcnow()
+    operations = list()
+    for key, submission in submissions.items():
+        updated_fields = {
+            field: submission[field] for field in SUBMISSION_UPDATED_FIELDS
+        }
+        if (existing := existing_submissions.get(key)) is None:
+            operations.append(
+                UpdateOne(
+                    {
+                        "contest_name": contest_name,
+                        "username": submission["username"],
+                        "data_region": submission["data_region"],
+                        "question_id": submission["question_id"],
+                    },
+                    {
+                        "$set": updated_fields | {"update_time": update_time},
+                        "$setOnInsert": {
+                            k: v
+                            for k, v in submission.items()
+                            if k not in updated_fields
+                        },
+                    },
+                    upsert=True,
+                )
+            )
+        elif any(existing.get(k) != v for k, v in updated_fields.items()):
+            operations.append(
+                UpdateOne(
+                    {"_id": existing["_id"]},
+                    {"$set": updated_fields | {"update_time": update_time}},
+                )
+            )
+    logger.info(
+        f"updating Submission collection {len(existing_submissions)=} {len(submissions)=} changed_num={len(operations)}"
+    )
+    error_num = await bulk_write_in_batches(Submission.__name__, operations)
     # Old submissions may be rejudged, must be deleted here, or will cause error when plotting.
-    await Submission.find(
-        Submission.contest_name == contest_name,
-        Submission.update_time < time_point,
-    ).delete()
+    stale_ids = [
+        doc["_id"]
+        for key, doc in existing_submissions.items()
+        if key not in submissions and key[0] not in unparsed_usernames
+    ]
+    if stale_ids:
+        result = await col.delete_many({"_id": {"$in": stale_ids}})
+        logger.info(f"removed stale submissions {result.deleted_count=}")
+    t2 = time.time()
+    logger.info(
+        f"submission ingestion {error_num=} cost {t2 - t1:.2f}s, {len(submissions) / (t2 - t1):.0f} rows/s"
+    )
     logger.success("finished updating submissions, begin to save real_time_rank")
     await save_questions_real_time_count(contest_name)
     await save_real_time_rank(contest_name)
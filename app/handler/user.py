@@ -1,44 +1,58 @@
+import asyncio
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, Final, List, Tuple
 
-from beanie.odm.operators.update.general import Set
 from loguru import logger
+from pymongo import UpdateOne
 
 from app.constants import (
     DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT,
     DEFAULT_NEW_USER_RATING,
 )
-from app.crawler.user import request_user_rating_and_attended_contests_count
+from app.crawler.user import (
+    iter_users_contest_history,
+    iter_users_rating_and_attended_contests_count,
+)
+from app.db.components import UserContestHistoryRecord
 from app.db.models import DATA_REGION, ContestRecordArchive, ContestRecordPredict, User
-from app.db.mongodb import get_async_mongodb_collection
+from app.db.mongodb import bulk_write_in_batches, get_async_mongodb_collection
 from app.db.views import UserKey
-from app.utils import exception_logger_reraise, gather_with_limited_concurrency
+from app.utils import exception_logger_reraise
+
+# flush upserts every so often while streaming, so that pending operations don't grow with the number of users
+USER_UPSERT_BATCH_SIZE: Final[int] = 1000
 
 
-async def upsert_users_rating_and_attended_contests_count(
+async def refresh_users_rating_and_attended_contests_count(
     data_region: DATA_REGION,
-    username: str,
+    usernames: List[str],
     save_new_user: bool = True,
+    concurrent_num: int = 5,
 ) -> None:
     """
-    Upsert users rating and attendedContestsCount by sending HTTP request to get latest data.
+    Upsert users rating and attendedContestsCount by sending HTTP requests to get latest data.
+    Users are processed one by one as soon as their responses arrive, and written back by bulk upserts.
     :param data_region:
-    :param username:
+    :param usernames:
     :param save_new_user:
+    :param concurrent_num:
     :return:
     """
-    try:
-        (
-            rating,
-            attended_contests_count,
-        ) = await request_user_rating_and_attended_contests_count(data_region, username)
+    operations = list()
+    async for username, result in iter_users_rating_and_attended_contests_count(
+        data_region, usernames, concurrent_num
+    ):
+        if result is None:
+            logger.error(f"user update error. {data_region=} {username=}")
+            continue
+        rating, attended_contests_count = result
         if rating is None:
             logger.info(
                 f"graphql data is None, new user found, {data_region=} {username=}"
             )
             if not save_new_user:
                 logger.info(f"{save_new_user=} do nothing.")
-                return
+                continue
             rating = DEFAULT_NEW_USER_RATING
             attended_contests_count = DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT
         user = User(
@@ -48,21 +62,107 @@ async def upsert_users_rating_and_attended_contests_count(
             attendedContestsCount=attended_contests_count,
             rating=rating,
         )
-        await User.find_one(
-            User.username == user.username,
-            User.data_region == user.data_region,
-        ).upsert(
-            Set(
+        updated_fields = {
+            "update_time": user.update_time,
+            "attendedContestsCount": user.attendedContestsCount,
+            "rating": user.rating,
+        }
+        operations.append(
+            UpdateOne(
+                {"username": user.username, "data_region": user.data_region},
                 {
-                    User.update_time: user.update_time,
-                    User.attendedContestsCount: user.attendedContestsCount,
-                    User.rating: user.rating,
-                }
-            ),
-            on_insert=user,
+                    "$set": updated_fields,
+                    "$setOnInsert": user.model_dump(
+                        exclude={"id", "revision_id", *updated_fields}
+                    ),
+                },
+                upsert=True,
+            )
+        )
+        if len(operations) >= USER_UPSERT_BATCH_SIZE:
+            await bulk_write_in_batches(User.__name__, operations)
+            operations = list()
+    await bulk_write_in_batches(User.__name__, operations)
+
+
+async def save_users_contest_history(
+    data_region: DATA_REGION,
+    usernames: List[str],
+    concurrent_num: int = 5,
+) -> None:
+    """
+    Request contest history of users by batched GraphQL requests and save it into `User.contest_history`,
+    users not in User collection are skipped.
+    :param data_region:
+    :param usernames:
+    :param concurrent_num:
+    :return:
+    """
+    operations = list()
+    async for username, history in iter_users_contest_history(
+        data_region, usernames, concurrent_num
+    ):
+        if history is None:
+            logger.error(f"user contest history error. {data_region=} {username=}")
+            continue
+        contest_history = [
+            UserContestHistoryRecord.model_validate(record).model_dump()
+            for record in history
+        ]
+        operations.append(
+            UpdateOne(
+                {"username": username, "data_region": data_region},
+                {"$set": {"contest_history": contest_history}},
+            )
+        )
+        if len(operations) >= USER_UPSERT_BATCH_SIZE:
+            await bulk_write_in_batches(User.__name__, operations)
+            operations = list()
+    await bulk_write_in_batches(User.__name__, operations)
+
+
+async def find_users_rating_and_attended_contests_count(
+    keys: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], Tuple[float, int]]:
+    """
+    Read rating and attendedContestsCount of many users from User collection in one query per data_region,
+    users not found are left out
+    :param keys: (username, data_region) list
+    :return:
+    """
+    col = get_async_mongodb_collection(User.__name__)
+    user_ratings = dict()
+    for data_region in ("CN", "US"):
+        usernames = [username for username, region in keys if region == data_region]
+        if not usernames:
+            continue
+        cursor = col.find(
+            {"data_region": data_region, "username": {"$in": usernames}},
+            {"_id": 0, "username": 1, "rating": 1, "attendedContestsCount": 1},
         )
-    except Exception as e:
-        logger.exception(f"user update error. {data_region=} {username=} Exception={e}")
+        async for doc in cursor:
+            user_ratings[(doc["username"], data_region)] = (
+                doc["rating"],
+                doc["attendedContestsCount"],
+            )
+    return user_ratings
+
+
+async def get_users_rating_and_attended_contests_count(
+    keys: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], Tuple[float, int]]:
+    """
+    Same as `find_users_rating_and_attended_contests_count`,
+    but users not found are treated as new users and get default values
+    :param keys: (username, data_region) list
+    :return:
+    """
+    user_ratings = {
+        key: (DEFAULT_NEW_USER_RATING, DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT)
+        for key in keys
+    }
+    user_ratings |= await find_users_rating_and_attended_contests_count(keys)
+    return user_ratings
 
 
 @exception_logger_reraise
@@ -86,28 +186,8 @@ async def update_all_users_in_database(
             .project(UserKey)
             .to_list()
         )
-        cn_tasks = []
-        us_tasks = []
-        for doc in docs:
-            if doc.data_region == "CN":
-                cn_tasks.append(
-                    upsert_users_rating_and_attended_contests_count(
-                        doc.data_region, doc.username, False
-                    )
-                )
-            else:
-                us_tasks.append(
-                    upsert_users_rating_and_attended_contests_count(
-                        doc.data_region, doc.username, False
-                    )
-                )
-        await gather_with_limited_concurrency(
-            [
-                # CN site has a strong rate limit
-                gather_with_limited_concurrency(cn_tasks, 1),
-                gather_with_limited_concurrency(us_tasks, 5),
-            ],
-            30,
+        await refresh_users_of_both_regions(
+            [(doc.username, doc.data_region) for doc in docs], save_new_user=False
         )
 
 
@@ -164,26 +244,33 @@ async def save_users_of_contest(
     cursor = col.aggregate(pipeline)
     docs = await cursor.to_list(length=None)
     logger.info(f"docs length = {len(docs)}")
-    cn_tasks = []
-    us_tasks = []
-    for doc in docs:
-        if doc["data_region"] == "CN":
-            cn_tasks.append(
-                upsert_users_rating_and_attended_contests_count(
-                    doc["data_region"], doc["username"]
-                )
-            )
-        else:
-            us_tasks.append(
-                upsert_users_rating_and_attended_contests_count(
-                    doc["data_region"], doc["username"]
-                )
-            )
-    await gather_with_limited_concurrency(
-        [
-            # CN site has a strong rate limit
-            gather_with_limited_concurrency(cn_tasks, 1),
-            gather_with_limited_concurrency(us_tasks, 5),
-        ],
-        30,
+    await refresh_users_of_both_regions(
+        [(doc["username"], doc["data_region"]) for doc in docs]
+    )
+
+
+async def refresh_users_of_both_regions(
+    keys: List[Tuple[str, str]],
+    save_new_user: bool = True,
+) -> None:
+    """
+    Refresh users of both data_regions at the same time
+    :param keys: (username, data_region) list
+    :param save_new_user:
+    :return:
+    """
+    await asyncio.gather(
+        # CN site has a strong rate limit, which is followed by its own host rate limiter rather than concurrency
+        refresh_users_rating_and_attended_contests_count(
+            "CN",
+            [username for username, data_region in keys if data_region == "CN"],
+            save_new_user,
+            concurrent_num=5,
+        ),
+        refresh_users_rating_and_attended_contests_count(
+            "US",
+            [username for username, data_region in keys if data_region != "CN"],
+            save_new_user,
+            concurrent_num=5,
+        ),
     )
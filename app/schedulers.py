@@ -14,6 +14,7 @@ from app.constants import (
     CronTimePointWkdHrMin,
 )
 from app.core.predictor import predict_contest
+from app.crawler.cache import evict_expired_cached_contests
 from app.handler.contest import (
     is_cn_contest_data_ready,
     save_recent_and_next_two_contests,
@@ -21,6 +22,7 @@ from app.handler.contest import (
 from app.handler.contest_record import (
     save_archive_contest_records,
     save_predict_contest_records,
+    save_provisional_contest_records,
 )
 from app.utils import exception_logger_reraise, get_passed_weeks
 
@@ -32,8 +34,10 @@ async def save_last_two_contest_records() -> None:
     """
     Update last weekly contest, and last biweekly contest.
     Upsert contest records in ContestRecordArchive, its users will also be updated in the save_archive_contest function.
+    Pages of older contests are evicted from crawl cache first.
     :return:
     """
+    evict_expired_cached_contests()
     utc = datetime.utcnow()
 
     biweekly_passed_weeks = get_passed_weeks(utc, BIWEEKLY_CONTEST_BASE.dt)
@@ -100,6 +104,8 @@ async def add_prediction_schedulers(contest_name: str) -> None:
     First add two save_predict_contest_records jobs to caching participants' info (mainly whose latest rating)
     by doing so can improve the speed of real calculation job greatly
     because we are wasting most of the time at fetching participants' info. (`save_users_of_contest` function)
+    Then add an interval save_provisional_contest_records job for provisional results during the contest,
+    it starts after the first caching job so that most participants' ratings are already cached.
     Then add one composed_predict_jobs (real calculation jobs)
     :param contest_name:
     :return:
@@ -114,6 +120,15 @@ async def add_prediction_schedulers(contest_name: str) -> None:
             trigger="date",
             run_date=pre_save_time,
         )
+    # provisional prediction every few minutes until the contest ends.
+    global_scheduler.add_job(
+        save_provisional_contest_records,
+        kwargs={"contest_name": contest_name},
+        trigger="interval",
+        minutes=5,
+        start_date=utc + timedelta(minutes=35),
+        end_date=utc + timedelta(minutes=90),
+    )
     # postpone 5 minutes to wait for LeetCode updating final result.
     predict_run_time = utc + timedelta(minutes=95)
     # real prediction running function.
@@ -2,7 +2,7 @@ import asyncio
 import math
 import sys
 from asyncio import iscoroutinefunction
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import partial, wraps
 from typing import Any, Callable, Coroutine, List, Sequence, Union
 
@@ -42,6 +42,15 @@ def get_passed_weeks(t: datetime, base_t: datetime) -> int:
     return math.floor((t - base_t).total_seconds() / (7 * 24 * 60 * 60))
 
 
+def to_naive_utc(t: datetime) -> datetime:
+    """
+    MongoDB gives back naive UTC datetime, convert aware datetime parsed by pydantic to the same form for comparison
+    :param t:
+    :return:
+    """
+    return t if t.tzinfo is None else t.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 def get_contest_start_time(contest_name: str) -> datetime:
     """
     It's a simple, bold, but EFFECTIVE conjecture here, take two baselines separately,
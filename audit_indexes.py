@@ -0,0 +1,25 @@
+import asyncio
+import sys
+
+from app.db.audit import audit_query_plans
+from app.db.mongodb import start_async_mongodb
+from app.utils import start_loguru
+
+
+async def start() -> int:
+    start_loguru()
+    # indexes declared in models are created here by beanie
+    await start_async_mongodb()
+    results = await audit_query_plans()
+    bad_results = [result for result in results if result["bad_stages"]]
+    for result in results:
+        print(
+            f"{'FAIL' if result['bad_stages'] else 'OK':<4} {result['name']:<40} "
+            f"{' <- '.join(result['stages'])}"
+        )
+    return 1 if bad_results else 0
+
+
+if __name__ == "__main__":
+    # exit with non-zero code when any hot query falls back to a collection scan or an in-memory sort
+    sys.exit(asyncio.run(start()))
@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+from typing import get_args
+
+from app.core.backtest import run_backtest
+from app.core.predictor import PREDICTION_ENGINE
+from app.crawler.utils import close_async_http_client
+from app.db.mongodb import start_async_mongodb
+from app.utils import start_loguru
+
+
+async def start(args: argparse.Namespace) -> None:
+    start_loguru()
+    await start_async_mongodb()
+    try:
+        await run_backtest(
+            engine=args.engine,
+            max_workers=args.max_workers,
+            output=args.output,
+            fetch_history=args.fetch_history,
+        )
+    finally:
+        await close_async_http_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backtest a prediction engine against archived contests"
+    )
+    parser.add_argument("--engine", choices=get_args(PREDICTION_ENGINE), default="auto")
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--output", default="backtest.json")
+    parser.add_argument(
+        "--fetch-history",
+        action="store_true",
+        help="request contest history of participants whose real rating is missing",
+    )
+    asyncio.run(start(parser.parse_args()))
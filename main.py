@@ -2,6 +2,8 @@ import asyncio
 
 from loguru import logger
 
+from app.crawler.cache import close_crawl_cache
+from app.crawler.utils import close_async_http_client
 from app.db.mongodb import start_async_mongodb
 from app.schedulers import start_scheduler
 from app.utils import start_loguru
@@ -22,5 +24,7 @@ if __name__ == "__main__":
     except (KeyboardInterrupt, SystemExit) as e:
         logger.critical(f"Closing loop. {e=}")
     finally:
+        loop.run_until_complete(close_async_http_client())
+        close_crawl_cache()
         loop.close()
         logger.critical("Closed loop.")
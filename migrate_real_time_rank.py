@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+from datetime import datetime
+from typing import get_args
+
+from app.db.codec import REAL_TIME_RANK_ENCODING
+from app.db.models import Contest
+from app.db.mongodb import start_async_mongodb
+from app.handler.submission import migrate_real_time_rank
+from app.utils import start_loguru
+
+
+async def start(args: argparse.Namespace) -> None:
+    start_loguru()
+    await start_async_mongodb()
+    contest_names = args.contests or [
+        contest.titleSlug
+        for contest in await Contest.find(
+            Contest.startTime < datetime.utcnow(),
+        )
+        .sort(-Contest.startTime)
+        .to_list()
+    ]
+    for contest_name in contest_names:
+        await migrate_real_time_rank(contest_name, args.encoding)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-encode stored real_time_rank of archived contests"
+    )
+    parser.add_argument(
+        "--encoding", choices=get_args(REAL_TIME_RANK_ENCODING), required=True
+    )
+    parser.add_argument(
+        "--contests", nargs="+", help="contest names, all past contests by default"
+    )
+    asyncio.run(start(parser.parse_args()))
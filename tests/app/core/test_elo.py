@@ -1,7 +1,12 @@
 import numpy as np
 import pytest
 
-from app.core.elo import elo_delta
+from app.core.elo import (
+    delta_coefficients,
+    elo_delta,
+    get_expected_rating,
+    get_expected_ratings,
+)
 from tests.utils import RATING_DELTA_PRECISION, read_data_contest_prediction_first
 
 
@@ -27,3 +32,66 @@ def test_elo_delta(data_contest_prediction_first):
     assert np.all(
         errors < RATING_DELTA_PRECISION
     ), f"Elo delta test failed. Some errors are not within {RATING_DELTA_PRECISION=}."
+
+
+def test_elo_delta_float32(data_contest_prediction_first):
+    """
+    Test function for the elo_delta function in reduced precision mode.
+
+     Raises:
+         AssertionError: If not all errors are within the specified precision.
+    """
+
+    ks, ranks, old_ratings, new_ratings = data_contest_prediction_first
+
+    delta_ratings = elo_delta(ranks, old_ratings, ks, np.float32)
+    testing_new_ratings = old_ratings + delta_ratings
+
+    errors = np.abs(new_ratings - testing_new_ratings)
+    assert np.all(
+        errors < RATING_DELTA_PRECISION
+    ), f"Elo delta float32 test failed. Some errors are not within {RATING_DELTA_PRECISION=}."
+
+
+def test_get_expected_ratings(data_contest_prediction_first):
+    """
+    Test function for the get_expected_ratings batch kernel.
+
+     Raises:
+         AssertionError: If batch results differ from the per-participant results.
+    """
+
+    _, ranks, old_ratings, _ = data_contest_prediction_first
+
+    sampled = np.arange(0, len(ranks), 97)
+    expected_ratings = get_expected_ratings(
+        ranks[sampled], old_ratings[sampled], old_ratings
+    )
+    single_expected_ratings = np.array(
+        [get_expected_rating(ranks[i], old_ratings[i], old_ratings) for i in sampled]
+    )
+
+    assert np.allclose(
+        expected_ratings, single_expected_ratings
+    ), "get_expected_ratings test failed. Batch results differ from get_expected_rating."
+
+
+def test_delta_coefficients():
+    """
+    Test function for the delta_coefficients lookup table.
+
+     Raises:
+         AssertionError: If table values differ from the series definition.
+    """
+
+    ks = np.arange(0, 200)
+    series_coefficients = np.array(
+        [
+            1 / (1 + sum((5 / 7) ** i for i in range(k + 1))) if k <= 100 else 2 / 9
+            for k in ks
+        ]
+    )
+
+    assert np.allclose(
+        delta_coefficients(ks), series_coefficients, rtol=0, atol=1e-12
+    ), "delta_coefficients test failed. Some coefficients differ from the series definition."
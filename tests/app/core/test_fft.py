@@ -1,7 +1,16 @@
 import numpy as np
 import pytest
+from scipy.signal import fftconvolve
 
-from app.core.fft import fft_delta
+from app.core.fft import (
+    EXPAND_SIZE,
+    MAX_RATING,
+    fft_delta,
+    get_expected_rating,
+    get_expected_ratings,
+    get_sigmoid_kernel,
+    pre_calc_convolution,
+)
 from tests.utils import RATING_DELTA_PRECISION, read_data_contest_prediction_first
 
 
@@ -27,3 +36,66 @@ def test_fft_delta(data_contest_prediction_first):
     assert np.all(
         errors < RATING_DELTA_PRECISION
     ), f"FFT delta test failed. Some errors are not within {RATING_DELTA_PRECISION=}."
+
+
+def test_get_expected_ratings(data_contest_prediction_first):
+    """
+    Test function for the vectorized get_expected_ratings function.
+
+    Raises:
+        AssertionError: If vectorized results differ from the binary search by more than one grid step.
+    """
+
+    _, ranks, old_ratings, _ = data_contest_prediction_first
+
+    convolution = pre_calc_convolution(old_ratings)
+    expected_ratings = get_expected_ratings(ranks, old_ratings, convolution)
+    single_expected_ratings = np.array(
+        [
+            get_expected_rating(rank, rating, convolution)
+            for rank, rating in zip(ranks, old_ratings)
+        ]
+    )
+
+    assert np.all(
+        np.abs(expected_ratings - single_expected_ratings) <= 1 / EXPAND_SIZE + 1e-9
+    ), "get_expected_ratings test failed. Results differ from get_expected_rating."
+
+
+def test_pre_calc_convolution(data_contest_prediction_first):
+    """
+    Test function for the pre_calc_convolution function with the cached kernel spectrum.
+
+    Raises:
+        AssertionError: If results differ from a plain fftconvolve.
+    """
+
+    _, _, old_ratings, _ = data_contest_prediction_first
+
+    g = np.bincount(np.round(old_ratings * EXPAND_SIZE).astype(int))
+    convolution = fftconvolve(get_sigmoid_kernel(), g, mode="full")[
+        : 2 * MAX_RATING + 1
+    ]
+
+    assert np.allclose(
+        pre_calc_convolution(old_ratings), convolution
+    ), "pre_calc_convolution test failed. Results differ from fftconvolve."
+
+
+def test_fft_delta_single_precision(data_contest_prediction_first):
+    """
+    Test function for the fft_delta function in reduced precision mode.
+
+    Raises:
+        AssertionError: If not all errors are within the specified precision.
+    """
+
+    ks, ranks, old_ratings, new_ratings = data_contest_prediction_first
+
+    delta_ratings = fft_delta(ranks, old_ratings, ks, np.float32)
+    testing_new_ratings = old_ratings + delta_ratings
+
+    errors = np.abs(new_ratings - testing_new_ratings)
+    assert np.all(
+        errors < RATING_DELTA_PRECISION
+    ), f"FFT float32 delta test failed. Some errors are not within {RATING_DELTA_PRECISION=}."
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import app.config
+from app.core.elo import elo_delta
+from app.core.predictor import PREDICTION_ENGINES, run_prediction_engine
+from tests.utils import RATING_DELTA_PRECISION, read_data_contest_prediction_first
+
+
+@pytest.fixture
+def sampled_contest_prediction_first():
+    # every 9th participant keeps the rating distribution, engines run in a fraction of the time
+    return tuple(array[::9] for array in read_data_contest_prediction_first())
+
+
+@pytest.fixture
+def reduced_precision_elo_engine(monkeypatch):
+    """
+    Run the elo engine with `predictor.reduced_precision` enabled, record dtypes it runs in.
+    float32 results are shifted by `float32_error`.
+    """
+    engine = {"dtypes": list(), "float32_error": 0.0}
+
+    def elo_delta_with_error(ranks, ratings, ks, dtype):
+        engine["dtypes"].append(dtype)
+        delta_ratings = elo_delta(ranks, ratings, ks, dtype)
+        if dtype == np.float32:
+            delta_ratings = delta_ratings + engine["float32_error"]
+        return delta_ratings
+
+    monkeypatch.setattr(
+        app.config,
+        "yaml_config",
+        {"predictor": {"engine": "elo", "reduced_precision": True}},
+    )
+    monkeypatch.setitem(PREDICTION_ENGINES, "elo", elo_delta_with_error)
+    return engine
+
+
+def test_run_prediction_engine_float32(
+    sampled_contest_prediction_first, reduced_precision_elo_engine
+):
+    """
+    Test function for run_prediction_engine in reduced precision mode.
+
+     Raises:
+         AssertionError: If an accurate float32 result falls back to float64, or is not within the precision.
+    """
+
+    ks, ranks, old_ratings, _ = sampled_contest_prediction_first
+
+    delta_ratings = run_prediction_engine(ranks, old_ratings, ks)
+
+    assert reduced_precision_elo_engine["dtypes"] == [np.float32]
+    assert np.all(
+        np.abs(delta_ratings - elo_delta(ranks, old_ratings, ks))
+        < RATING_DELTA_PRECISION
+    )
+
+
+def test_run_prediction_engine_float64_fallback(
+    sampled_contest_prediction_first, reduced_precision_elo_engine
+):
+    """
+    Test function for the float64 fallback of run_prediction_engine.
+    Every float32 result is shifted by twice `RATING_DELTA_PRECISION`, so the sampled exact check must reject it.
+
+     Raises:
+         AssertionError: If it doesn't fall back, or the fallback result is not the exact float64 one.
+    """
+
+    ks, ranks, old_ratings, _ = sampled_contest_prediction_first
+    reduced_precision_elo_engine["float32_error"] = 2 * RATING_DELTA_PRECISION
+
+    delta_ratings = run_prediction_engine(ranks, old_ratings, ks)
+
+    assert reduced_precision_elo_engine["dtypes"] == [np.float32, np.float64]
+    assert np.array_equal(delta_ratings, elo_delta(ranks, old_ratings, ks))
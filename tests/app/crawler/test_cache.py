@@ -0,0 +1,148 @@
+import asyncio
+from collections import Counter
+
+import httpx
+import pytest
+
+import app.config
+import app.crawler.cache
+from app.crawler.cache import (
+    evict_expired_cached_contests,
+    get_crawl_cache_connection,
+    load_cached_page,
+    save_cached_page,
+)
+from app.crawler.contest_record_and_submission import request_contest_records
+from tests.utils import use_mock_http_transport
+
+# far in the future, its ranking is never final
+LIVE_CONTEST_NAME = "weekly-contest-9999"
+# long ago, its ranking is final
+FINAL_CONTEST_NAME = "weekly-contest-300"
+PAGE_NUM = 4
+
+
+@pytest.fixture
+def ranking_server(monkeypatch, tmp_path):
+    """
+    Serve `PAGE_NUM` ranking pages with an ETag, answer 304 to a matching If-None-Match,
+    pages in `server["broken_pages"]` always fail.
+    """
+    server = {"requests": Counter(), "broken_pages": set()}
+
+    def handler(request):
+        page = int(request.url.params.get("pagination", 0))
+        server["requests"][page] += 1
+        if page in server["broken_pages"]:
+            raise httpx.ConnectError("connection refused")
+        if request.headers.get("If-None-Match") == '"v1"':
+            server["requests"]["304"] += 1
+            return httpx.Response(304)
+        payload = (
+            {"user_num": 25 * PAGE_NUM}
+            if page == 0
+            else {"total_rank": [{"page": page}] * 25, "submissions": [{}] * 25}
+        )
+        return httpx.Response(200, json=payload, headers={"ETag": '"v1"'})
+
+    monkeypatch.setattr(app.crawler.cache, "crawl_cache_connection", None)
+    use_mock_http_transport(
+        monkeypatch,
+        handler,
+        {"crawl_cache": {"path": str(tmp_path / "crawl_cache.sqlite3"), "ttl": 3600}},
+    )
+    yield server
+    app.crawler.cache.close_crawl_cache()
+
+
+def crawl(contest_name):
+    contest_record_list, _ = asyncio.run(
+        request_contest_records(contest_name, "US", use_cache=True)
+    )
+    return contest_record_list
+
+
+def set_ttl(ttl):
+    app.config.yaml_config["http"]["crawl_cache"]["ttl"] = ttl
+
+
+def test_cache_hit_within_ttl(ranking_server):
+    """
+    Test function for serving a non-final contest from cache within TTL.
+
+    Raises:
+        AssertionError: If a fresh cached page is requested again, or cached records differ from fetched ones.
+    """
+
+    fetched = crawl(LIVE_CONTEST_NAME)
+    assert len(fetched) == 25 * PAGE_NUM
+    ranking_server["requests"].clear()
+    assert crawl(LIVE_CONTEST_NAME) == fetched
+    assert sum(ranking_server["requests"].values()) == 0
+
+
+def test_cache_revalidation(ranking_server):
+    """
+    Test function for revalidating stale pages of a non-final contest by conditional requests.
+
+    Raises:
+        AssertionError: If a stale page is not revalidated, 304 doesn't serve the cached page,
+            or 304 doesn't restart its TTL.
+    """
+
+    fetched = crawl(LIVE_CONTEST_NAME)
+    fetched_at = load_cached_page("US", LIVE_CONTEST_NAME, 1).fetched_at
+    set_ttl(0)
+    ranking_server["requests"].clear()
+    assert crawl(LIVE_CONTEST_NAME) == fetched
+    assert ranking_server["requests"]["304"] == PAGE_NUM + 1
+    assert load_cached_page("US", LIVE_CONTEST_NAME, 1).fetched_at > fetched_at
+
+
+def test_cache_finality(ranking_server):
+    """
+    Test function for pages fetched after the ranking became final.
+
+    Raises:
+        AssertionError: If a final page is revalidated even though TTL has expired.
+    """
+
+    fetched = crawl(FINAL_CONTEST_NAME)
+    set_ttl(0)
+    ranking_server["requests"].clear()
+    assert crawl(FINAL_CONTEST_NAME) == fetched
+    assert sum(ranking_server["requests"].values()) == 0
+
+
+def test_cache_resume(ranking_server):
+    """
+    Test function for resuming an interrupted crawl, pages are cached one by one as soon as fetched.
+
+    Raises:
+        AssertionError: If pages cached by the interrupted crawl are requested again.
+    """
+
+    ranking_server["broken_pages"].add(3)
+    assert len(crawl(LIVE_CONTEST_NAME)) == 25 * (PAGE_NUM - 1)
+    ranking_server["broken_pages"].clear()
+    ranking_server["requests"].clear()
+    assert [record["page"] for record in crawl(LIVE_CONTEST_NAME)] == [
+        page for page in range(1, PAGE_NUM + 1) for _ in range(25)
+    ]
+    assert ranking_server["requests"] == {3: 1}
+
+
+def test_evict_expired_cached_contests(ranking_server):
+    """
+    Test function for evicting pages of contests out of the archive window.
+
+    Raises:
+        AssertionError: If pages of an old contest are kept, or pages of a recent contest are evicted.
+    """
+
+    save_cached_page("US", FINAL_CONTEST_NAME, 1, b"{}")
+    save_cached_page("CN", LIVE_CONTEST_NAME, 1, b"{}")
+    evict_expired_cached_contests()
+    assert get_crawl_cache_connection().execute(
+        "SELECT DISTINCT contest_name FROM ranking_page"
+    ).fetchall() == [(LIVE_CONTEST_NAME,)]
@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+import httpx
+
+from app.crawler.user import (
+    get_users_rating_request,
+    iter_users_rating_and_attended_contests_count,
+    parse_users_rating,
+    split_into_batches,
+)
+from tests.utils import use_mock_http_transport
+
+
+def request_all(usernames, batch_size):
+    async def collect():
+        return [
+            item
+            async for item in iter_users_rating_and_attended_contests_count(
+                "US", usernames, batch_size=batch_size
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_users_rating_request_round_trip():
+    """
+    Test function for aliased batch requests and parsing their payload back to users.
+
+    Raises:
+        AssertionError: If a user is mapped to another user's field, or a null field is not a new user.
+    """
+
+    usernames = ("alice", "bob", "carol")
+    request = get_users_rating_request("US", usernames)
+    assert request["url"] == "https://leetcode.com/graphql/"
+    assert request["json"]["variables"] == {"u0": "alice", "u1": "bob", "u2": "carol"}
+    assert "u2: userContestRanking(username: $u2)" in request["json"]["query"]
+    payload = {
+        "data": {
+            "u0": {"rating": 1600.5, "attendedContestsCount": 3},
+            "u1": None,
+            "u2": {"rating": 2100.0, "attendedContestsCount": 40},
+        }
+    }
+    assert parse_users_rating(payload, usernames) == {
+        "alice": (1600.5, 3),
+        "bob": (None, None),
+        "carol": (2100.0, 40),
+    }
+    assert parse_users_rating({"errors": [{"message": "busy"}]}, usernames) is None
+    assert split_into_batches(["a", "b", "c", "d", "e"], 2) == [
+        ("a", "b"),
+        ("c", "d"),
+        ("e",),
+    ]
+
+
+def test_batch_split_on_graphql_errors(monkeypatch):
+    """
+    Test function for splitting batches when GraphQL reports errors.
+    A batch with errors is split in halves until single users, a single user with a null field is a new user.
+
+    Raises:
+        AssertionError: If users of a failed batch are lost, or healthy users don't get their ratings.
+    """
+
+    batch_sizes = list()
+
+    def handler(request):
+        variables = json.loads(request.content)["variables"]
+        batch_sizes.append(len(variables))
+        data = {
+            alias: None
+            if username == "ghost"
+            else {"rating": 1500 + len(username), "attendedContestsCount": 1}
+            for alias, username in variables.items()
+        }
+        payload = {"data": data}
+        if "ghost" in variables.values():
+            payload["errors"] = [{"message": "That user does not exist."}]
+        return httpx.Response(200, json=payload)
+
+    use_mock_http_transport(monkeypatch, handler)
+    usernames = [f"user{i}" for i in range(7)] + ["ghost"]
+    results = dict(request_all(usernames, batch_size=8))
+    assert results == {
+        **{f"user{i}": (1505, 1) for i in range(7)},
+        "ghost": (None, None),
+    }
+    # 8 -> 4 + 4 -> 2 + 2 -> 1 + 1
+    assert sorted(batch_sizes) == [1, 1, 2, 2, 4, 4, 8]
+
+
+def test_batch_not_split_on_transport_failure(monkeypatch):
+    """
+    Test function for a batch which reached max retry_num on transport level.
+
+    Raises:
+        AssertionError: If the batch is split, or its users are not yielded as failed.
+    """
+
+    batch_sizes = list()
+
+    def handler(request):
+        variables = json.loads(request.content)["variables"]
+        batch_sizes.append(len(variables))
+        if "down" in variables.values():
+            return httpx.Response(503)
+        return httpx.Response(
+            200,
+            json={
+                "data": {
+                    alias: {"rating": 1500, "attendedContestsCount": 0}
+                    for alias in variables
+                }
+            },
+        )
+
+    use_mock_http_transport(monkeypatch, handler)
+    results = dict(request_all(["a", "b", "down", "c"], batch_size=3))
+    assert results == {"a": None, "b": None, "down": None, "c": (1500, 0)}
+    assert sorted(batch_sizes) == [1] + [3] * 10
@@ -0,0 +1,261 @@
+import asyncio
+import time
+from collections import Counter
+
+import httpx
+import pytest
+
+import app.crawler.utils
+from app.crawler.contest_record_and_submission import request_contest_records
+from app.crawler.utils import (
+    HostRateLimiter,
+    get_host_rate_limiter,
+    multi_http_request_stream,
+    send_http_request,
+)
+from tests.utils import use_mock_http_transport
+
+
+async def collect(stream):
+    return [item async for item in stream]
+
+
+def test_multi_http_request_stream_sliding_window(monkeypatch):
+    """
+    Test function for the sliding window of multi_http_request_stream.
+
+    Raises:
+        AssertionError: If more than `concurrent_num` requests are in flight, the window is not kept full,
+            or results are not yielded in the order they finish.
+    """
+
+    in_flight = Counter()
+
+    async def handler(request):
+        key = int(request.url.params["key"])
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        # larger keys finish earlier
+        await asyncio.sleep((10 - key) * 0.01)
+        in_flight["now"] -= 1
+        return httpx.Response(200, json={"key": key})
+
+    use_mock_http_transport(monkeypatch, handler)
+    results = asyncio.run(
+        collect(
+            multi_http_request_stream(
+                {
+                    key: {"url": f"https://leetcode.com/?key={key}", "method": "GET"}
+                    for key in range(10)
+                },
+                concurrent_num=3,
+            )
+        )
+    )
+    assert in_flight["max"] == 3
+    assert sorted(results) == [(key, {"key": key}) for key in range(10)]
+    # the fastest request of the first window is yielded first
+    assert results[0] == (2, {"key": 2})
+
+
+def test_multi_http_request_stream_retry(monkeypatch):
+    """
+    Test function for retrying failed requests in multi_http_request_stream.
+    Server errors, transport errors and unparsable bodies are all retried.
+
+    Raises:
+        AssertionError: If a request which eventually succeeds is not yielded with its payload.
+    """
+
+    sent = Counter()
+
+    def handler(request):
+        key = request.url.params["key"]
+        sent[key] += 1
+        if sent[key] == 1:
+            if key == "server":
+                return httpx.Response(503)
+            if key == "transport":
+                raise httpx.ConnectError("connection refused")
+            if key == "parse":
+                return httpx.Response(200, content=b"<html>")
+        return httpx.Response(200, json={"key": key})
+
+    use_mock_http_transport(monkeypatch, handler)
+    keys = ["server", "transport", "parse", "ok"]
+    results = asyncio.run(
+        collect(
+            multi_http_request_stream(
+                {
+                    key: {"url": f"https://leetcode.com/?key={key}", "method": "GET"}
+                    for key in keys
+                }
+            )
+        )
+    )
+    assert dict(results) == {key: {"key": key} for key in keys}
+    assert sent == {"server": 2, "transport": 2, "parse": 2, "ok": 1}
+
+
+def test_multi_http_request_stream_max_retry(monkeypatch):
+    """
+    Test function for a request which always fails in multi_http_request_stream.
+
+    Raises:
+        AssertionError: If it's not yielded as None after exactly `retry_num` attempts, or other requests are affected.
+    """
+
+    sent = Counter()
+
+    def handler(request):
+        key = request.url.params["key"]
+        sent[key] += 1
+        if key == "broken":
+            return httpx.Response(500)
+        return httpx.Response(200, json={"key": key})
+
+    use_mock_http_transport(monkeypatch, handler)
+    results = asyncio.run(
+        collect(
+            multi_http_request_stream(
+                {
+                    key: {"url": f"https://leetcode.com/?key={key}", "method": "GET"}
+                    for key in ["broken", "ok"]
+                },
+                retry_num=3,
+            )
+        )
+    )
+    assert dict(results) == {"broken": None, "ok": {"key": "ok"}}
+    assert sent == {"broken": 3, "ok": 1}
+
+
+def test_request_contest_records_page_order(monkeypatch):
+    """
+    Test function for request_contest_records when later pages arrive first.
+
+    Raises:
+        AssertionError: If records are not in page order.
+    """
+
+    async def handler(request):
+        if (page := request.url.params.get("pagination")) is None:
+            return httpx.Response(200, json={"user_num": 25 * 6})
+        page = int(page)
+        await asyncio.sleep((6 - page) * 0.01)
+        return httpx.Response(
+            200,
+            json={
+                "total_rank": [{"page": page, "i": i} for i in range(25)],
+                "submissions": [{"page": page}] * 25,
+            },
+        )
+
+    use_mock_http_transport(monkeypatch, handler)
+    contest_record_list, nested_submission_list = asyncio.run(
+        request_contest_records("weekly-contest-300", "CN")
+    )
+    assert [(record["page"], record["i"]) for record in contest_record_list] == [
+        (page, i) for page in range(1, 7) for i in range(25)
+    ]
+    assert [submission["page"] for submission in nested_submission_list] == [
+        page for page in range(1, 7) for _ in range(25)
+    ]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.crawler.utils.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_host_rate_limiter_aimd(clock):
+    """
+    Test function for the AIMD rate tuning of HostRateLimiter.
+
+    Raises:
+        AssertionError: If successes don't increase the rate additively, throttling doesn't decrease it
+            multiplicatively at most once per token, or the rate leaves [min_rate, max_rate].
+    """
+
+    limiter = HostRateLimiter(
+        "leetcode.com",
+        rate=10,
+        min_rate=1,
+        max_rate=12,
+        additive_increase=2,
+        multiplicative_decrease=0.5,
+    )
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(10.2)
+
+    limiter.on_throttled()
+    assert limiter.rate == pytest.approx(5.1)
+    # responses of requests sent before the decrease arrive within one token interval
+    clock[0] += 0.1
+    limiter.on_throttled()
+    assert limiter.rate == pytest.approx(5.1)
+    clock[0] += 1 / 5.1
+    limiter.on_throttled()
+    assert limiter.rate == pytest.approx(2.55)
+
+    for _ in range(10):
+        clock[0] += 1
+        limiter.on_throttled()
+    assert limiter.rate == 1
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 12
+    assert limiter.stats()["throttled_num"] == 13
+    assert limiter.stats()["success_num"] == 101
+
+
+def test_host_rate_limiter_acquire():
+    """
+    Test function for the token bucket of HostRateLimiter.
+
+    Raises:
+        AssertionError: If tokens beyond `burst` are handed out faster than `rate`.
+    """
+
+    async def acquire_all(limiter, num):
+        t1 = time.monotonic()
+        await asyncio.gather(*[limiter.acquire() for _ in range(num)])
+        return time.monotonic() - t1
+
+    limiter = HostRateLimiter("leetcode.com", rate=50, burst=2)
+    # 2 tokens of burst at once, then 4 more tokens at 50 per second
+    assert asyncio.run(acquire_all(limiter, 6)) >= 4 / 50 * 0.9
+
+
+def test_send_http_request_signals(monkeypatch):
+    """
+    Test function for how send_http_request reports responses to the host rate limiter.
+
+    Raises:
+        AssertionError: If 429, 5xx and timeouts are not throttling signals, or other failures are.
+    """
+
+    def handler(request):
+        status_code = int(request.url.params["status"])
+        if status_code == 0:
+            raise httpx.ReadTimeout("timeout", request=request)
+        return httpx.Response(status_code)
+
+    use_mock_http_transport(monkeypatch, handler)
+
+    async def send_all():
+        for status_code in [200, 304, 429, 503, 0, 404]:
+            await send_http_request(
+                status_code,
+                {"url": f"https://leetcode.cn/?status={status_code}", "method": "GET"},
+            )
+
+    asyncio.run(send_all())
+    stats = get_host_rate_limiter("leetcode.cn").stats()
+    assert (stats["success_num"], stats["throttled_num"], stats["failed_num"]) == (
+        2,
+        3,
+        1,
+    )
@@ -0,0 +1,95 @@
+import pytest
+
+from app.db.codec import (
+    UINT16_TAG,
+    UINT32_TAG,
+    VARINT_TAG,
+    decode_real_time_rank,
+    encode_real_time_rank,
+    pack_real_time_rank,
+    unpack_real_time_rank,
+)
+from app.db.models import ContestRecordArchive
+
+
+def test_pack_real_time_rank_width():
+    """
+    Test function for switching from uint16 to uint32 once a rank exceeds 65535.
+
+     Raises:
+         AssertionError: If the width tag or the decoded ranks are wrong.
+    """
+
+    ranks = [1, 65535, 300, 65535]
+    data = pack_real_time_rank(ranks)
+    assert data[0] == UINT16_TAG and len(data) == 1 + 2 * len(ranks)
+    assert unpack_real_time_rank(data) == ranks
+
+    ranks = [1, 65536, 300, 4294967295]
+    data = pack_real_time_rank(ranks)
+    assert data[0] == UINT32_TAG and len(data) == 1 + 4 * len(ranks)
+    assert unpack_real_time_rank(data) == ranks
+
+
+def test_pack_real_time_rank_varint():
+    """
+    Test function for varint encoding, ranks go up and down so deltas are both positive and negative.
+
+     Raises:
+         AssertionError: If the decoded ranks differ from the original ones.
+    """
+
+    ranks = [30000, 29000, 29000, 1, 2, 100000, 99999, 1, 64, 63, 65, 8000, 7936]
+    data = pack_real_time_rank(ranks, varint=True)
+    assert data[0] == VARINT_TAG
+    assert unpack_real_time_rank(data) == ranks
+    # small deltas take a single byte each
+    assert len(pack_real_time_rank([5, 4, 3, 4, 5], varint=True)) == 1 + 5
+
+
+@pytest.mark.parametrize("varint", [False, True])
+def test_pack_real_time_rank_empty(varint):
+    """
+    Test function for an empty real_time_rank list.
+
+     Raises:
+         AssertionError: If an empty list doesn't round-trip.
+    """
+
+    data = pack_real_time_rank([], varint=varint)
+    assert len(data) == 1
+    assert unpack_real_time_rank(data) == []
+
+
+def test_decode_real_time_rank():
+    """
+    Test function for storage encodings, lists and None are kept as is, bytes are decoded.
+
+     Raises:
+         AssertionError: If any encoding doesn't round-trip.
+    """
+
+    ranks = [3, 2, 70000, 1]
+    for encoding in ["list", "packed", "varint"]:
+        assert decode_real_time_rank(encode_real_time_rank(ranks, encoding)) == ranks
+    assert decode_real_time_rank(None) is None
+    with pytest.raises(ValueError):
+        unpack_real_time_rank(b"\x09\x00")
+
+
+def test_contest_record_archive_decodes_real_time_rank():
+    """
+    Test function for the `real_time_rank` field validator of ContestRecordArchive.
+    Validated by assignment, so that no MongoDB connection is needed.
+
+     Raises:
+         AssertionError: If the stored bytes are not decoded into a list.
+    """
+
+    ranks = [10, 9, 70000, 8]
+    for encoding in ["list", "packed", "varint"]:
+        record = ContestRecordArchive.model_construct()
+        ContestRecordArchive.__pydantic_validator__.validate_assignment(
+            record, "real_time_rank", encode_real_time_rank(ranks, encoding)
+        )
+        assert record.real_time_rank == ranks
@@ -0,0 +1,112 @@
+import pytest
+
+from app.db.models import (
+    ContestRecordArchive,
+    ContestRecordPredict,
+    ContestRecordProvisional,
+)
+from app.handler.contest_record import (
+    parse_contest_record,
+    parse_unique_contest_records,
+)
+from app.utils import to_naive_utc
+
+CONTEST_RECORD_MODELS = [
+    ContestRecordArchive,
+    ContestRecordPredict,
+    ContestRecordProvisional,
+]
+# fields filled by default factories, their values depend on when they are built
+TIME_DEFAULT_FIELDS = {"update_time", "insert_time"}
+
+
+@pytest.fixture(autouse=True)
+def documents_without_database(monkeypatch):
+    """
+    Beanie documents can only be built after `init_beanie`, a collection isn't needed to validate them.
+    """
+    for model in CONTEST_RECORD_MODELS:
+        monkeypatch.setattr(
+            model, "get_motor_collection", classmethod(lambda cls: None)
+        )
+
+
+def get_contest_record_dict(**kwargs):
+    return {
+        "contest_id": 1000,
+        "username": "alice",
+        "user_slug": "alice",
+        "data_region": "CN",
+        "country_code": "CN",
+        "country_name": None,
+        "rank": 3,
+        "score": 18,
+        "finish_time": 1700000000,
+        # fields which are not in the model are dropped
+        "global_ranking": 7,
+    } | kwargs
+
+
+def validate_contest_record(contest_record_dict, model):
+    contest_record = model.model_validate(
+        contest_record_dict | {"contest_name": "weekly-contest-300"}
+    ).model_dump(exclude={"id", "revision_id"})
+    contest_record["finish_time"] = to_naive_utc(contest_record["finish_time"])
+    return contest_record
+
+
+def assert_same_contest_record(parsed, validated):
+    assert parsed.keys() == validated.keys()
+    for field, value in validated.items():
+        if field in TIME_DEFAULT_FIELDS:
+            continue
+        assert parsed[field] == value, field
+        assert type(parsed[field]) is type(value), field
+
+
+@pytest.mark.parametrize("model", CONTEST_RECORD_MODELS)
+@pytest.mark.parametrize(
+    "contest_record_dict",
+    [
+        get_contest_record_dict(),
+        get_contest_record_dict(data_region="US", country_code=None),
+        # wrong types take the pydantic fallback
+        get_contest_record_dict(rank="3"),
+        get_contest_record_dict(finish_time="2023-11-14T22:13:20Z"),
+    ],
+)
+def test_parse_contest_record(model, contest_record_dict):
+    """
+    Test function for parse_contest_record against model_validate.
+
+    Raises:
+        AssertionError: If any field, or its type, differs from what model_validate gives.
+    """
+
+    assert_same_contest_record(
+        parse_contest_record("weekly-contest-300", dict(contest_record_dict), model),
+        validate_contest_record(contest_record_dict, model),
+    )
+
+
+def test_parse_unique_contest_records():
+    """
+    Test function for parse_unique_contest_records.
+
+    Raises:
+        AssertionError: If a duplicated user is not dropped, or US users are not keyed by `user_slug`.
+    """
+
+    contest_record_list = [
+        get_contest_record_dict(username="Alice", user_slug="alice", rank=1),
+        get_contest_record_dict(username="Bob", user_slug="bob", rank=2),
+        # during the contest, the same user may appear again on a later page
+        get_contest_record_dict(username="Alice", user_slug="alice", rank=3),
+    ]
+    contest_records = parse_unique_contest_records(
+        "weekly-contest-300", "US", contest_record_list, ContestRecordPredict
+    )
+    assert [(record["username"], record["rank"]) for record in contest_records] == [
+        ("alice", 1),
+        ("bob", 2),
+    ]
@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+
+from app.db.models import Submission
+from app.handler.submission import get_real_time_ranks, validate_submission
+from app.utils import to_naive_utc
+
+MINUTE = 60 * 1000
+
+
+def brute_force_real_time_ranks(
+    user_indices, dates, credits, fail_counts, user_num, time_points
+):
+    """
+    Straightforward reimplementation of the old per-time_point MongoDB aggregation:
+    group submissions up to the time_point, sort by (-credit_sum, penalty_date),
+    tied users share the rank of the first one, users without any submission get `last_rank + 1`.
+    """
+    ranks = np.empty((user_num, len(time_points)), dtype=np.int64)
+    for i, time_point in enumerate(time_points):
+        groups = dict()
+        for user, date, credit, fail_count in zip(
+            user_indices, dates, credits, fail_counts
+        ):
+            if date > time_point:
+                continue
+            credit_sum, fail_count_sum, date_max = groups.get(user, (0, 0, None))
+            groups[user] = (
+                credit_sum + credit,
+                fail_count_sum + fail_count,
+                date if date_max is None else max(date_max, date),
+            )
+        docs = sorted(
+            (-credit_sum, date_max + fail_count_sum * 5 * MINUTE, user)
+            for user, (credit_sum, fail_count_sum, date_max) in groups.items()
+        )
+        ranks[:, i] = len(docs) + 1
+        last_pair = None
+        tie_rank = 0
+        for raw_rank, (neg_credit_sum, penalty_date, user) in enumerate(docs, 1):
+            if (neg_credit_sum, penalty_date) != last_pair:
+                tie_rank = raw_rank
+            ranks[user, i] = tie_rank
+            last_pair = (neg_credit_sum, penalty_date)
+    return ranks
+
+
+def test_get_real_time_ranks():
+    """
+    Test function for the get_real_time_ranks sweep against the old aggregation semantics.
+
+     Raises:
+         AssertionError: If any rank differs from the brute-force ranks.
+    """
+
+    rng = np.random.default_rng(0)
+    time_points = np.arange(1, 11) * 10 * MINUTE
+    for _ in range(200):
+        user_num = int(rng.integers(1, 30))
+        submission_num = int(rng.integers(0, 60))
+        user_indices = rng.integers(0, user_num, submission_num)
+        # coarse dates and few credit values make ties common, some dates are after the last time_point
+        dates = rng.integers(0, 12, submission_num) * 10 * MINUTE
+        credits = rng.choice([3, 4, 5, 6], submission_num)
+        fail_counts = rng.integers(0, 3, submission_num)
+
+        ranks = get_real_time_ranks(
+            user_indices, dates, credits, fail_counts, user_num, time_points
+        )
+        expected_ranks = brute_force_real_time_ranks(
+            user_indices, dates, credits, fail_counts, user_num, time_points
+        )
+
+        assert np.array_equal(
+            ranks, expected_ranks
+        ), f"get_real_time_ranks test failed. {user_indices=} {dates=} {credits=} {fail_counts=}"
+
+
+def test_get_real_time_ranks_ties_and_absent_users():
+    """
+    Test function for tie ranks and the `last_rank + 1` fill of users without submissions.
+
+     Raises:
+         AssertionError: If ranks are not the hand-computed ones.
+    """
+
+    time_points = np.array([10, 20]) * MINUTE
+    # user 0 and user 1 tie at the first time_point, user 1 gets ahead at the second, user 2 never submits
+    user_indices = np.array([0, 1, 1])
+    dates = np.array([5, 5, 15]) * MINUTE
+    credits = np.array([3, 3, 4])
+    fail_counts = np.array([0, 0, 0])
+
+    ranks = get_real_time_ranks(
+        user_indices, dates, credits, fail_counts, 3, time_points
+    )
+
+    assert ranks.tolist() == [[1, 2], [1, 1], [3, 3]]
+
+
+@pytest.fixture
+def submission_without_database(monkeypatch):
+    """
+    Beanie documents can only be built after `init_beanie`, a collection isn't needed to validate them.
+    """
+    monkeypatch.setattr(
+        Submission, "get_motor_collection", classmethod(lambda cls: None)
+    )
+
+
+def get_submission_dict(**kwargs):
+    return {
+        # LeetCode's own id, not the document id
+        "id": 123456,
+        "date": 1700000000,
+        "question_id": 2000,
+        "submission_id": 480000000,
+        "status": 10,
+        "contest_id": 1000,
+        "data_region": "CN",
+        "fail_count": 1,
+        "lang": "python3",
+    } | kwargs
+
+
+@pytest.mark.parametrize(
+    "submission_dict",
+    [
+        get_submission_dict(),
+        # US data_region doesn't have `lang` before weekly-contest-364
+        {k: v for k, v in get_submission_dict(data_region="US").items() if k != "lang"},
+        # wrong types take the pydantic fallback
+        get_submission_dict(date="2023-11-14T22:13:20Z"),
+        get_submission_dict(question_id="2000", fail_count=1.0),
+    ],
+)
+def test_validate_submission(submission_without_database, submission_dict):
+    """
+    Test function for validate_submission against Submission.model_validate.
+
+     Raises:
+         AssertionError: If any field, or its type, differs from what model_validate gives.
+    """
+
+    submission = validate_submission(
+        "weekly-contest-300", "alice", 4, dict(submission_dict)
+    )
+    expected_submission = Submission.model_validate(
+        {k: v for k, v in submission_dict.items() if k != "id"}
+        | {"contest_name": "weekly-contest-300", "username": "alice", "credit": 4}
+    ).model_dump(exclude={"id", "revision_id", "update_time"})
+    expected_submission["date"] = to_naive_utc(expected_submission["date"])
+
+    assert submission.keys() == expected_submission.keys()
+    for field, value in expected_submission.items():
+        assert submission[field] == value, field
+        assert type(submission[field]) is type(value), field
+
+
+def test_validate_submission_invalid(submission_without_database):
+    """
+    Test function for a submission which neither parse_submission nor pydantic can convert.
+
+     Raises:
+         AssertionError: If it's not dropped as None.
+    """
+
+    assert (
+        validate_submission(
+            "weekly-contest-300",
+            "alice",
+            4,
+            get_submission_dict(question_id="two thousand"),
+        )
+        is None
+    )
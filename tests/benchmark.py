@@ -0,0 +1,164 @@
+"""
+Benchmark suite for `app.core` on synthetic contests of increasing size.
+
+Usage:
+    python -m tests.benchmark --output bench.json
+    python -m tests.benchmark --sizes 1000 10000 --engines fft_delta delta_coefficients
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Callable, Dict, Final, List, Optional, Tuple
+
+import numba
+import numpy as np
+
+from app.constants import (
+    DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT,
+    DEFAULT_NEW_USER_RATING,
+)
+from app.core.elo import delta_coefficients, elo_delta
+from app.core.fft import fft_delta
+
+DEFAULT_SIZES: Final[List[int]] = [1_000, 10_000, 30_000, 100_000]
+# share of participants who are new users, all of them have exactly DEFAULT_NEW_USER_RATING
+NEW_USER_RATIO: Final[float] = 0.3
+WARMUP_USER_NUM: Final[int] = 100
+
+ENGINES: Final[Dict[str, Callable[..., np.ndarray]]] = {
+    "elo_delta": elo_delta,
+    "fft_delta": fft_delta,
+    "delta_coefficients": lambda ranks, ratings, ks: delta_coefficients(ks),
+}
+
+
+def generate_synthetic_contest(
+    user_num: int,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generate a realistic contest: right-skewed ratings of experienced users,
+    a spike of new users at DEFAULT_NEW_USER_RATING, and ranks loosely correlated with ratings.
+    :param user_num:
+    :param seed:
+    :return: ks, ranks, ratings
+    """
+    rng = np.random.default_rng(seed)
+    new_user_num = int(user_num * NEW_USER_RATIO)
+    old_user_num = user_num - new_user_num
+    ratings = np.concatenate(
+        [
+            np.clip(
+                1350 + rng.gamma(shape=2.0, scale=150.0, size=old_user_num), 0, 3800
+            ),
+            np.full(new_user_num, DEFAULT_NEW_USER_RATING),
+        ]
+    )
+    ks = np.concatenate(
+        [
+            1 + rng.geometric(p=0.05, size=old_user_num),
+            np.full(new_user_num, DEFAULT_NEW_USER_ATTENDED_CONTESTS_COUNT),
+        ]
+    )
+    # better rating gets better rank in general, with a lot of noise
+    performance = ratings + rng.normal(0, 300, size=user_num)
+    ranks = np.empty(user_num, dtype=np.float64)
+    ranks[np.argsort(-performance)] = np.arange(1, user_num + 1)
+    order = np.argsort(ranks)
+    return ks[order].astype(np.float64), ranks[order], ratings[order]
+
+
+def get_git_commit() -> Optional[str]:
+    """
+    Current git commit, so that results of different commits can be told apart
+    :return:
+    """
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_engine(
+    engine: str,
+    sizes: List[int],
+    repeat: int,
+) -> List[Dict]:
+    """
+    Time JIT / cache warm-up on a tiny contest first, then time every size `repeat` times
+    :param engine:
+    :param sizes:
+    :param repeat:
+    :return:
+    """
+    func = ENGINES[engine]
+    ks, ranks, ratings = generate_synthetic_contest(WARMUP_USER_NUM)
+    t1 = time.perf_counter()
+    func(ranks, ratings, ks)
+    warmup_seconds = time.perf_counter() - t1
+    results = list()
+    for user_num in sizes:
+        ks, ranks, ratings = generate_synthetic_contest(user_num)
+        seconds = list()
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            func(ranks, ratings, ks)
+            seconds.append(time.perf_counter() - t1)
+        results.append(
+            {
+                "engine": engine,
+                "user_num": user_num,
+                "warmup_seconds": round(warmup_seconds, 6),
+                "seconds": [round(s, 6) for s in seconds],
+                "min_seconds": round(min(seconds), 6),
+                "median_seconds": round(float(np.median(seconds)), 6),
+            }
+        )
+        print(f"{engine=} {user_num=} min_seconds={min(seconds):.4f}", flush=True)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark app.core engines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="bench.json")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "numba": numba.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numba_threads": numba.get_num_threads(),
+            "repeat": args.repeat,
+        },
+        "results": [
+            result
+            for engine in args.engines
+            for result in benchmark_engine(engine, args.sizes, args.repeat)
+        ],
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
-from typing import Final
-
+import httpx
 import numpy as np
 
-# Ensure that the prediction error for rating deltas for EACH participant is within the specified precision limit
-RATING_DELTA_PRECISION: Final[float] = 0.05
+import app.config
+import app.crawler.utils
+from app.constants import RATING_DELTA_PRECISION  # noqa: F401
 
 
 def read_data_contest_prediction_first():
@@ -14,3 +14,31 @@ def read_data_contest_prediction_first():
         old_ratings = data[:, 2]
         new_ratings = data[:, 3]
         return ks, ranks, old_ratings, new_ratings
+
+
+def use_mock_http_transport(monkeypatch, handler, http_config=None):
+    """
+    Route the shared http client of crawlers to `handler`, with fresh and fast rate limiters.
+    `handler` takes an `httpx.Request` and returns an `httpx.Response`, it could be a coroutine function.
+    """
+    monkeypatch.setattr(
+        app.config,
+        "yaml_config",
+        {
+            "http": {
+                "rate_limit": {
+                    "rate": 1000,
+                    "min_rate": 100,
+                    "max_rate": 1000,
+                    "burst": 100,
+                }
+            }
+            | (http_config or dict())
+        },
+    )
+    monkeypatch.setattr(app.crawler.utils, "host_rate_limiters", dict())
+    monkeypatch.setattr(
+        app.crawler.utils,
+        "async_http_client",
+        httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )